@@ -182,6 +182,73 @@ def undistort_point(p, newcameramtx, dist=DIST):
     return cv.undistortPoints(np.expand_dims(p, axis=0), newcameramtx, dist).squeeze()
 
 
+class DetectionCorrector:
+    """
+    Undistortion and homography transformation of bounding boxes, combined for a specific camera frame size.
+    Corrects Nx4 arrays of (x1, y1, x2, y2) boxes at once, and gives the same result as calling undistort_point
+    and then transform_point on each corner.
+
+    Optionally, the undistortion of every pixel in the frame is precomputed into a dense lookup map, and points
+    are undistorted by bilinear interpolation in the map instead of by the iterative cv.undistortPoints.
+    """
+
+    def __init__(self, homography, newcameramtx, dist=DIST, frame_size=None):
+        """
+        :param homography: homography matrix, 3X3 numpy array
+        :param newcameramtx: numpy array, camera matrix for the specific (width, height) frame.
+        :param dist: numpy array, distortion coefficients
+        :param frame_size: (width, height) tuple. If given, a dense undistortion lookup map is precomputed.
+        """
+        self.homography = homography
+        self.newcameramtx = newcameramtx
+        self.dist = dist
+        self.lookup = None
+        if frame_size is not None:
+            width, height = frame_size
+            xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+            pixels = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2)
+            self.lookup = cv.undistortPoints(pixels, newcameramtx, dist).reshape(height, width, 2)
+
+    def undistort(self, points):
+        """
+        :param points: Mx2 numpy array of points without NaN values
+        :return: Mx2 numpy array, undistorted points
+        """
+        if self.lookup is None:
+            return cv.undistortPoints(points.reshape(-1, 1, 2), self.newcameramtx, self.dist).reshape(-1, 2)
+
+        # bilinear interpolation in the lookup map. points outside the frame are clamped to its edges.
+        height, width = self.lookup.shape[:2]
+        x = np.clip(points[:, 0], 0, width - 1)
+        y = np.clip(points[:, 1], 0, height - 1)
+        x0 = np.minimum(x.astype(int), width - 2)
+        y0 = np.minimum(y.astype(int), height - 2)
+        fx = (x - x0)[:, None]
+        fy = (y - y0)[:, None]
+        top = self.lookup[y0, x0] * (1 - fx) + self.lookup[y0, x0 + 1] * fx
+        bottom = self.lookup[y0 + 1, x0] * (1 - fx) + self.lookup[y0 + 1, x0 + 1] * fx
+        return top * (1 - fy) + bottom * fy
+
+    def correct(self, boxes):
+        """
+        :param boxes: numpy array of boxes, Nx4 or a single box. Only the first 4 columns (x1, y1, x2, y2) are used.
+        :return: numpy array of the corrected boxes in the shape of the input (4 columns). Boxes with NaN values
+                 stay NaN.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64)
+        is_single = boxes.ndim == 1
+        points = boxes.reshape(-1, boxes.shape[-1])[:, :4].reshape(-1, 2)
+
+        corrected = np.full(points.shape, np.nan)
+        valid = ~np.isnan(points).any(axis=1)
+        if valid.any():
+            undistorted = self.undistort(points[valid])
+            corrected[valid] = cv.perspectiveTransform(undistorted.reshape(-1, 1, 2), self.homography).reshape(-1, 2)
+
+        corrected = corrected.reshape(-1, 4)
+        return corrected[0] if is_single else corrected
+
+
 def undistort_data(
     data, width, height, cols=(("x1", "y1"), ("x2", "y2")), mtx=MTX, dist=DIST, alpha=0,
 ):
@@ -22,6 +22,7 @@ import json
 from pathlib import Path
 
 from Prediction.detector import nearest_detection
+from Prediction.records import load_records
 import Prediction.calibration as calib
 
 # various folder and file names constants
@@ -44,6 +45,8 @@ VID_STATS_FN = "vid_stats.json"
 
 TIMESTAMPS_FN = "timestamps/" + REALTIME_ID + ".csv"
 TOUCHES_FN = "screen_touches.csv"
+PREDICTOR_HISTORY_FN = "predictor_history.bin"
+FORECASTS_FN = "forecasts.bin"
 BUG_TRAJ_FN = "bug_trajectory.csv"
 
 # various folders and terms in the experiments folder to exclude from the analysis and data collection
@@ -265,6 +268,8 @@ def analyze_single_video(
     :param num_frames: int, number of frames to analyze from the video
     :return: 2D numpy array of detections
     """
+    # frames are passed to the detector in batches of its batch size (1 for detectors without batched inference)
+    batch_size = getattr(detector, "batch_size", 1)
 
     vcap = cv.VideoCapture(str(video_path))
 
@@ -287,41 +292,74 @@ def analyze_single_video(
 
     vcap.set(cv.CAP_PROP_POS_FRAMES, start_frame)
 
-    # inference on each frame
-    for frameCounter in tqdm(range(num_frames)):
-        ret, frame = vcap.read()
+    # inference on batches of frames
+    for batch_start in tqdm(range(0, num_frames, batch_size)):
+        frames = []
+        for _ in range(min(batch_size, num_frames - batch_start)):
+            ret, frame = vcap.read()
 
-        if not ret:
-            raise DatasetException("Error reading frame.")
+            if not ret:
+                raise DatasetException("Error reading frame.")
+            frames.append(frame)
 
-        detections = detector.detect_image(frame)
+        if batch_size == 1:
+            batch_detections = [detector.detect_image(frames[0])]
+            curr_imgs = [detector.curr_img]
+        else:
+            batch_detections = detector.detect_batch(frames)
+            curr_imgs = detector.curr_imgs
 
-        if detections is not None:
-            if frameCounter > 0:
-                prev = frames_data[frameCounter - 1][:2]
-                detection = nearest_detection(detections, prev)
-            else:
-                detection = detections[0]
+        for i, detections in enumerate(batch_detections):
+            frameCounter = batch_start + i
+            handle_frame_detections(frames_data, head_crops, frameCounter, detections, curr_imgs[i],
+                                    (height, width))
 
-            # insert new detection in matrix, each row is x1, y1, x2, y2, confidence.
-            frames_data[frameCounter][0:5] = detection
-            frames_data[frameCounter][5] = detections.shape[0]
+    vcap.release()
 
-            cropped_head = get_cropped_head(
-                detector.curr_img, detection, (height, width)
-            )
+    return frames_data, head_crops, width, height
 
-            # append cropped head to list
-            head_crops.append(cropped_head)
 
+def handle_frame_detections(frames_data, head_crops, frameCounter, detections, curr_img, orig_dim):
+    """
+    Insert the detections of a single frame to frames_data and its cropped head to head_crops
+    (used by analyze_single_video)
+    """
+    if detections is not None:
+        if frameCounter > 0:
+            prev = frames_data[frameCounter - 1][:2]
+            detection = nearest_detection(detections, prev)
         else:
-            # if no there's no detection, append None element so the order will be kept
-            head_crops.append(None)
-            frames_data[frameCounter][5] = 0
+            detection = detections[0]
 
-    vcap.release()
+        # insert new detection in matrix, each row is x1, y1, x2, y2, confidence.
+        frames_data[frameCounter][0:5] = detection
+        frames_data[frameCounter][5] = detections.shape[0]
 
-    return frames_data, head_crops, width, height
+        cropped_head = get_cropped_head(curr_img, detection, orig_dim)
+
+        # append cropped head to list
+        head_crops.append(cropped_head)
+
+    else:
+        # if no there's no detection, append None element so the order will be kept
+        head_crops.append(None)
+        frames_data[frameCounter][5] = 0
+
+
+def load_predictor_records(videos_dir: Path):
+    """
+    Memory-map the detections history and the forecasts that the realtime predictor recorded during a trial.
+    Each is a numpy structured array with the fields frame, time and bbox (history) or forecast (forecasts).
+
+    :param videos_dir: path to the folder of the trial videos, in which the predictor files are saved
+    :return: (history, forecasts), None for a missing file
+    """
+    videos_dir = Path(videos_dir)
+    history_path = videos_dir / PREDICTOR_HISTORY_FN
+    forecasts_path = videos_dir / FORECASTS_FN
+    history = load_records(history_path) if history_path.exists() else None
+    forecasts = load_records(forecasts_path) if forecasts_path.exists() else None
+    return history, forecasts
 
 
 def find_last_homography(experiment_path: Path):
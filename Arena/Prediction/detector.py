@@ -1,16 +1,37 @@
 """
 This module is responsible for implementing the detector of the animal's head. Contains an abstract class of a Detector,
-and currently a single implementation of such detector using the YOLO-v4 algorithm. It's possible to use other detectors
+and two implementations of such detector using the YOLO-v4 algorithm: Detector_v4 runs on the GPU with darknet, and
+Detector_v4_cpu runs the same network on the CPU with the OpenCV DNN module. It's possible to use other detectors
 with the same contract of the Detector abstract class. Additionally, it contains various functions for transforming
 between different bounding box formats and computing the IoU metric.
 """
 
 import numpy as np
 import cv2 as cv
-from ctypes import c_int, pointer
+from ctypes import c_int, c_float, c_uint8, pointer, POINTER, cast, sizeof
 
-import Prediction.Yolo4.darknet as darknet4
 import torch
+from frames import Frame
+
+# darknet bindings are loaded by Detector_v4, since libdarknet.so can't be loaded on machines without a GPU
+darknet4 = None
+# numpy view of the darknet DETECTION struct, for reading a whole detections array at once
+DETECTION_DTYPE = None
+
+
+def load_darknet():
+    """Load the darknet bindings on first use"""
+    global darknet4, DETECTION_DTYPE
+    if darknet4 is None:
+        import Prediction.Yolo4.darknet as darknet_module
+        DETECTION_DTYPE = np.dtype({
+            'names': ['bbox', 'prob'],
+            'formats': [(np.float32, 4), np.uintp],
+            'offsets': [darknet_module.DETECTION.bbox.offset, darknet_module.DETECTION.prob.offset],
+            'itemsize': sizeof(darknet_module.DETECTION)
+        })
+        darknet4 = darknet_module
+    return darknet4
 
 
 class Detector:
@@ -29,11 +50,30 @@ class Detector:
         Each row represents one detection as [left_x, top_y, right_x, bottom_y, confidence] of
         the bounding box, where (0,0) is the top left corner of the image.
 
-        :param img: numpy array image (cv2 frame etc.)
+        :param img: numpy array image (cv2 frame etc.) or a Frame object
         :return: Nx5 numpy detection array for the supplied image
         """
         pass
 
+    def detect_batch(self, imgs):
+        """
+        Detect objects in a sequence of images of the same size. Subclasses that support batched inference
+        should override this method, the default implementation calls detect_image on each image.
+        The resized image of each detection (self.curr_img, if the detector keeps it) is collected in
+        self.curr_imgs.
+
+        :param imgs: list of numpy array images or Frame objects
+        :return: list with the detect_image result (Nx5 numpy array or None) of each image
+        """
+        results = []
+        self.curr_imgs = []
+        for img in imgs:
+            results.append(self.detect_image(img))
+            curr_img = getattr(self, "curr_img", None)
+            # curr_img is usually a view on a buffer that is overwritten by the next detection
+            self.curr_imgs.append(curr_img if len(imgs) == 1 or curr_img is None else curr_img.copy())
+        return results
+
 
 class Detector_v4(Detector):
     """
@@ -41,7 +81,9 @@ class Detector_v4(Detector):
     "YOLOv4: Optimal Speed and Accuracy of Object Detection"
     Code from: https://github.com/AlexeyAB/darknet, including a python wrapper for the C modules.
 
-    The resized image used for the last detection is stored in self.curr_img
+    The resized image used for the last detection is stored in self.curr_img, and the resized images of the
+    last batch are stored in self.curr_imgs. These are views on the persistent input buffer of the detector,
+    so they are valid until the next detection.
     """
 
     def __init__(self,
@@ -49,7 +91,8 @@ class Detector_v4(Detector):
                  weights_path="Prediction/Yolo4/yolo4_gs_best_2306.weights",
                  meta_path="Prediction/Yolo4/obj.data",
                  conf_thres=0.9,
-                 nms_thres=0.6):
+                 nms_thres=0.6,
+                 batch_size=1):
         """
         Initialize detector. Requires at least 1.4GB of GPU memory.
         Note: Because the detector is implemented in C and code is basically Python bindings for it, errors will
@@ -61,16 +104,28 @@ class Detector_v4(Detector):
         :param meta_path: Path to yolo metadata file (pretty useless for inference but necessary)
         :param conf_thres: float in (0,1), confidence threshold for bounding box detections
         :param nms_thres: float in (0,1), Non-max suppression threshold. Suppresses multiple detections for the same object.
+        :param batch_size: number of images in a single inference of detect_batch.
         """
+        load_darknet()
         self.net = darknet4.load_net_custom(cfg_path.encode("ascii"),
                                             weights_path.encode("ascii"),
-                                            0, 1)
+                                            0, batch_size)
+        self.batch_size = batch_size
+        self.net_batch = batch_size  # darknet resets the network batch to 1 on single image inference
         self.meta = darknet4.load_meta(meta_path.encode("ascii"))
         self.model_width = darknet4.lib.network_width(self.net)
         self.model_height = darknet4.lib.network_height(self.net)
         self.conf_thres = conf_thres
         self.nms_thres = nms_thres
         self.curr_img = None
+        self.curr_imgs = []
+
+        # persistent network input, filled in place on every detection: resized RGB images and
+        # normalized CHW float images, wrapped by a single darknet IMAGE
+        self.resized = np.empty((batch_size, self.model_height, self.model_width, 3), dtype=np.uint8)
+        self.input_data = np.empty((batch_size, 3, self.model_height, self.model_width), dtype=np.float32)
+        self.input_image = darknet4.IMAGE(self.model_width, self.model_height, 3,
+                                          self.input_data.ctypes.data_as(POINTER(c_float)))
         print("Detector initiated successfully")
 
     def set_conf_and_nms(self, new_conf_thres=0.9, new_nms_thres=0.6):
@@ -84,38 +139,111 @@ class Detector_v4(Detector):
         """
         Bounding box inference on input frame
 
-        :param img: numpy array image
+        :param img: numpy array image in BGR order (cv2 frame), or a Frame object which is converted only if needed.
         :return: numpy array of detections. Each row is x1, y1, x2, y1, confidence  (top-left and bottom-right corners).
         """
 
         input_height, input_width, _ = img.shape
 
-        image = cv.cvtColor(img, cv.COLOR_BGR2RGB)
-        image = cv.resize(image, (self.model_width, self.model_height), interpolation=cv.INTER_LINEAR)
-        self.curr_img = image
+        self.fill_input(img, 0)
+        self.curr_img = self.resized[0]
 
         # C bindings for Darknet inference
-        image, arr = darknet4.array_to_image(image)
         num = c_int(0)
         pnum = pointer(num)
-        darknet4.predict_image(self.net, image)
+        darknet4.predict_image(self.net, self.input_image)
+        self.net_batch = 1
 
         dets = darknet4.get_network_boxes(self.net, input_width, input_height,
                                           self.conf_thres, self.conf_thres, None, 0, pnum, 0)
 
         num = pnum[0]
+        res = self.decode_detections(dets, num)
+        darknet4.free_detections(dets, num)
+        return res
+
+    def detect_batch(self, imgs):
+        """
+        Bounding box inference on a batch of frames of the same size, using a single network_predict_batch call
+        for every batch_size frames. Detections of the unused slots of the last batch are ignored.
+
+        :param imgs: list of numpy array images in BGR order, or Frame objects.
+        :return: list of the detections of each image, in the format of detect_image.
+        """
+        if self.batch_size == 1:
+            return super().detect_batch(imgs)
+
+        if self.net_batch != self.batch_size:
+            darknet4.set_batch_network(self.net, self.batch_size)
+            self.net_batch = self.batch_size
+
+        results = []
+        self.curr_imgs = []
+        for batch_start in range(0, len(imgs), self.batch_size):
+            batch = imgs[batch_start:batch_start + self.batch_size]
+            input_height, input_width, _ = batch[0].shape
+
+            for i, img in enumerate(batch):
+                assert img.shape[:2] == (input_height, input_width), 'all images in a batch must have the same size'
+                self.fill_input(img, i)
+            # the resized images are overwritten by the next batch, so they are copied if there are more batches
+            resized = self.resized[:len(batch)]
+            self.curr_imgs.extend(resized if len(imgs) <= self.batch_size else resized.copy())
+
+            batch_dets = darknet4.network_predict_batch(self.net, self.input_image, self.batch_size,
+                                                        input_width, input_height,
+                                                        self.conf_thres, self.conf_thres, None, 0, 0)
+            for i in range(len(batch)):
+                results.append(self.decode_detections(batch_dets[i].dets, batch_dets[i].num))
+            darknet4.free_batch_detections(batch_dets, self.batch_size)
+
+        return results
+
+    def fill_input(self, img, slot):
+        """
+        Resize an image into the input buffer slot, and write it normalized in CHW order to the network input.
+
+        :param img: numpy array image in BGR order, or a Frame object.
+        :param slot: index of the image in the input batch.
+        """
+        resized = self.resized[slot]
+        is_rgb = isinstance(img, Frame) and img.channel_order == 'RGB'
+        if isinstance(img, Frame):
+            img = img.data
+        cv.resize(img, (self.model_width, self.model_height), dst=resized, interpolation=cv.INTER_LINEAR)
+        if not is_rgb:
+            # the color conversion runs after the resize, on the small image
+            cv.cvtColor(resized, cv.COLOR_BGR2RGB, dst=resized)
+
+        data = self.input_data[slot]
+        data[...] = resized.transpose(2, 0, 1)
+        data /= 255.0
+
+    def decode_detections(self, dets, num):
+        """
+        Apply NMS to darknet detections and convert them to an Nx5 xyxy + confidence array.
+        The detections are not freed.
+
+        :return: numpy array of detections, or None if there are no detections.
+        """
         if self.nms_thres:
             darknet4.do_nms_sort(dets, num, self.meta.classes, self.nms_thres)
 
-        # change format of bounding boxes
-        res = np.zeros((num, 5))
-        for i in range(num):
-            b = dets[i].bbox
-            res[i] = [b.x - b.w / 2, b.y - b.h / 2, b.x + b.w / 2, b.y + b.h / 2, dets[i].prob[0]]
-        nonzero = res[:, 4] > 0
-        res = res[nonzero]
+        if num == 0:
+            return None
+
+        # read the whole detections array, and only dereference the class probability pointer of each detection
+        records = np.ctypeslib.as_array(cast(dets, POINTER(c_uint8)), shape=(num * DETECTION_DTYPE.itemsize,))
+        records = records.view(DETECTION_DTYPE)
+        conf = np.array([c_float.from_address(int(p)).value for p in records['prob']])
+        nonzero = conf > 0
 
-        darknet4.free_detections(dets, num)
+        # change format of bounding boxes from center x, y, width, height
+        xywh = records['bbox'][nonzero].astype(np.float64)
+        res = np.empty((xywh.shape[0], 5))
+        res[:, 0:2] = xywh[:, 0:2] - xywh[:, 2:4] / 2
+        res[:, 2:4] = xywh[:, 0:2] + xywh[:, 2:4] / 2
+        res[:, 4] = conf[nonzero]
 
         if res.shape[0] == 0:
             return None
@@ -123,6 +251,103 @@ class Detector_v4(Detector):
             return res
 
 
+class Detector_v4_cpu(Detector):
+    """
+    CPU implementation of the YOLO-v4 detector for machines without a GPU. Runs the same darknet configuration and
+    weights as Detector_v4 using the OpenCV DNN module with multi-threaded inference, and returns detections
+    in the same format.
+
+    The resized image used for the last detection is stored in self.curr_img
+    """
+
+    def __init__(self,
+                 cfg_path="Prediction/Yolo4/yolo4_2306.cfg",
+                 weights_path="Prediction/Yolo4/yolo4_gs_best_2306.weights",
+                 conf_thres=0.9,
+                 nms_thres=0.6,
+                 num_threads=None):
+        """
+        :param cfg_path: Path to yolo network configuration file
+        :param weights_path: Path to trained network weights
+        :param conf_thres: float in (0,1), confidence threshold for bounding box detections
+        :param nms_thres: float in (0,1), Non-max suppression threshold. Suppresses multiple detections for the same object.
+        :param num_threads: number of threads used by OpenCV. Uses the OpenCV default if None or 0.
+        """
+        self.net = cv.dnn.readNetFromDarknet(cfg_path, weights_path)
+        self.net.setPreferableBackend(cv.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+        if num_threads:
+            cv.setNumThreads(num_threads)
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+        self.model_width, self.model_height = read_cfg_input_size(cfg_path)
+        self.conf_thres = conf_thres
+        self.nms_thres = nms_thres
+        self.resized = np.empty((self.model_height, self.model_width, 3), dtype=np.uint8)
+        self.curr_img = None
+        print("CPU detector initiated successfully")
+
+    def set_conf_and_nms(self, new_conf_thres=0.9, new_nms_thres=0.6):
+        """
+        Set new confidence threshold and nms threshold values.
+        """
+        self.conf_thres = new_conf_thres
+        self.nms_thres = new_nms_thres
+
+    def detect_image(self, img):
+        """
+        Bounding box inference on input frame
+
+        :param img: numpy array image in BGR order (cv2 frame), or a Frame object.
+        :return: numpy array of detections. Each row is x1, y1, x2, y1, confidence  (top-left and bottom-right corners).
+        """
+        input_height, input_width, _ = img.shape
+        is_rgb = isinstance(img, Frame) and img.channel_order == 'RGB'
+        if isinstance(img, Frame):
+            img = img.data
+        cv.resize(img, (self.model_width, self.model_height), dst=self.resized, interpolation=cv.INTER_LINEAR)
+        if not is_rgb:
+            cv.cvtColor(self.resized, cv.COLOR_BGR2RGB, dst=self.resized)
+        self.curr_img = self.resized
+
+        blob = cv.dnn.blobFromImage(self.resized, 1 / 255.0, swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # each row of the yolo outputs is center x, y, width, height (relative), objectness, class scores
+        outputs = np.vstack(self.net.forward(self.output_names))
+        conf = outputs[:, 5]
+        outputs, conf = outputs[conf > self.conf_thres], conf[conf > self.conf_thres]
+
+        xywh = outputs[:, :4].astype(np.float64) * [input_width, input_height, input_width, input_height]
+        xywh[:, :2] -= xywh[:, 2:] / 2  # top-left corner
+        if self.nms_thres:
+            keep = cv.dnn.NMSBoxes(xywh.tolist(), conf.tolist(), self.conf_thres, self.nms_thres)
+            keep = np.array(keep, dtype=int).reshape(-1)
+        else:
+            keep = np.argsort(-conf)
+
+        if keep.shape[0] == 0:
+            return None
+
+        res = np.empty((keep.shape[0], 5))
+        res[:, 0:2] = xywh[keep, 0:2]
+        res[:, 2:4] = xywh[keep, 0:2] + xywh[keep, 2:4]
+        res[:, 4] = conf[keep]
+        return res
+
+
+def read_cfg_input_size(cfg_path):
+    """Read the network input width and height from the [net] section of a darknet configuration file"""
+    size = {}
+    with open(cfg_path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line.startswith('[') and line != '[net]':
+                break
+            key, _, value = line.partition('=')
+            if key.strip() in ('width', 'height'):
+                size[key.strip()] = int(value)
+    return size['width'], size['height']
+
+
 def xywh_to_centroid(xywh):
     """
     :param xywh: bbox numpy array in x, y, width, height.
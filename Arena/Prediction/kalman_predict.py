@@ -1,13 +1,18 @@
 """
 Module for trajectory prediction using Kalman filters.
 
+LightKalmanFilter - a Kalman filter of independent input dimensions over preallocated numpy arrays, numerically
+equivalent (up to rounding errors) to the filterpy KalmanFilter of create_kalman_filter.
 create_kalman_filter - a function for creating a Kalman filter object based on the filterpy library
+create_light_kalman_filter - the same filter as a LightKalmanFilter, used by the predictors and the offline filters.
 KalmanPredictor - a subclass of TrajectoryPredictor that generates trajectory forecasts using kalman filters.
+filter_trial, filter_trials - offline filtering (and optional RTS smoothing) of the trajectories of one or many trials,
+using the vectorized batch_kalman_filter.
+benchmark_filterpy - compare the results and the running time of LightKalmanFilter and filterpy's KalmanFilter.
 """
 
+import time
 import numpy as np
-from filterpy.kalman import KalmanFilter
-from filterpy.common import Q_discrete_white_noise
 from scipy.linalg import block_diag
 from Prediction.predictor import TrajectoryPredictor
 
@@ -30,6 +35,8 @@ def create_kalman_filter(
 
     :return: Kalman filter object
     """
+    from filterpy.kalman import KalmanFilter
+    from filterpy.common import Q_discrete_white_noise
 
     kf = KalmanFilter(dim_x=input_dim * num_terms, dim_z=input_dim)
     if init_x is None:
@@ -37,39 +44,205 @@ def create_kalman_filter(
     else:
         kf.x = init_x
 
-    # state transition matrix
+    kf.F = transition_matrix(input_dim, num_terms, dt)  # state transition matrix
+    kf.H = measurement_matrix(input_dim, num_terms)  # measurement function
+
+    kf.P *= 1.0  # covariance matrix
+    kf.R *= r_var  # measurement noise variance
+
+    # process noise covariance matrix
+    q = Q_discrete_white_noise(dim=num_terms, dt=dt, var=q_var)
+    kf.Q = block_diag(*([q] * input_dim))
+
+    return kf
+
+
+def create_light_kalman_filter(
+    init_x=None, input_dim=2, num_terms=2, dt=1, r_var=5.0, q_var=0.1
+):
+    """
+    Create a LightKalmanFilter equivalent to the filter of create_kalman_filter (same parameters).
+    Unlike filterpy's KalmanFilter, its matrices are fixed at creation and can't be assigned afterwards.
+
+    :return: LightKalmanFilter object
+    """
+    return LightKalmanFilter(input_dim, num_terms, dt=dt, r_var=r_var, q_var=q_var, init_x=init_x)
+
+
+def white_noise_covariance(dim, dt=1.0, var=1.0):
+    """
+    Process noise covariance of a single input dimension with dim terms, for a discrete white noise model.
+    Same values as filterpy.common.Q_discrete_white_noise.
+
+    :param dim: number of terms (2, 3 or 4)
+    :param dt: time step
+    :param var: variance of the noise
+    """
+    if dim == 2:
+        q = [[0.25 * dt ** 4, 0.5 * dt ** 3],
+             [0.5 * dt ** 3, dt ** 2]]
+    elif dim == 3:
+        q = [[0.25 * dt ** 4, 0.5 * dt ** 3, 0.5 * dt ** 2],
+             [0.5 * dt ** 3, dt ** 2, dt],
+             [0.5 * dt ** 2, dt, 1]]
+    elif dim == 4:
+        q = [[(dt ** 6) / 36, (dt ** 5) / 12, (dt ** 4) / 6, (dt ** 3) / 6],
+             [(dt ** 5) / 12, (dt ** 4) / 4, (dt ** 3) / 2, (dt ** 2) / 2],
+             [(dt ** 4) / 6, (dt ** 3) / 2, dt ** 2, dt],
+             [(dt ** 3) / 6, (dt ** 2) / 2, dt, 1.0]]
+    else:
+        raise ValueError(f'white noise covariance is supported for 2, 3 or 4 terms, got {dim}')
+
+    return np.array(q, dtype=float) * var
+
+
+class LightKalmanFilter:
+    """
+    A Kalman filter of independent input dimensions with the same dynamic model (constant velocity, constant
+    acceleration, etc.), specialized for the per-frame hot path of the predictors.
+
+    It's the filter that create_kalman_filter builds with filterpy: F, Q and P are block diagonal with one
+    (num_terms x num_terms) block per input dimension, H takes the position term of each dimension and R = r_var * I.
+    Since all the blocks start equal (P = I) and go through the same equations, their covariances stay equal, so a
+    single covariance block is kept for all the dimensions and the state vector is handled as an (input_dim, num_terms)
+    matrix. The innovation covariance of each dimension is then a scalar, and there's no matrix inversion.
+    The equations are filterpy's (including the Joseph form of the covariance update), and all the intermediate
+    arrays are preallocated and written in place.
+    """
+
+    def __init__(self, input_dim=2, num_terms=2, dt=1, r_var=5.0, q_var=0.1, init_x=None):
+        """
+        :param input_dim: dimensions of input
+        :param num_terms: number of terms in the dynamic system (2 for constant velocity, 3 for constant accel, etc.)
+        :param dt: time step
+        :param r_var: variance of measurement noise
+        :param q_var: variance of process white noise
+        :param init_x: initial state vector (size: input_dim * num_terms), zeros if None
+        """
+        self.input_dim = input_dim
+        self.num_terms = num_terms
+        self.r_var = float(r_var)
+        self.f = transition_matrix(1, num_terms, dt)
+        self.fT = np.ascontiguousarray(self.f.T)
+        self.q = white_noise_covariance(num_terms, dt, q_var)
+        self._I = np.eye(num_terms)
+
+        # the state vector, and a (input_dim, num_terms) view of it
+        self.x = np.zeros(input_dim * num_terms)
+        self._X = self.x.reshape(input_dim, num_terms)
+        # covariance block of every input dimension
+        self.p = np.eye(num_terms)
+        # kalman gain block and residual
+        self.k = np.zeros(num_terms)
+        self.y = np.zeros(input_dim)
+
+        # preallocated intermediate results
+        self._X_tmp = np.zeros((input_dim, num_terms))
+        self._p_tmp = np.zeros((num_terms, num_terms))
+        self._kk = np.zeros((num_terms, num_terms))
+        self._i_kh = np.eye(num_terms)
+
+        self.reset(init_x)
+
+    @property
+    def P(self):
+        """The full (block diagonal) state covariance matrix"""
+        return np.kron(np.eye(self.input_dim), self.p)
+
+    def reset(self, x=None):
+        """
+        Reset the state vector to x (zeros if None) and the state covariance to the identity matrix.
+        """
+        if x is None:
+            self.x[:] = 0.0
+        else:
+            self.x[:] = x
+        self.p[:] = self._I
+
+    def predict(self):
+        """
+        x = F x
+        P = F P F' + Q
+        """
+        np.dot(self._X, self.fT, out=self._X_tmp)
+        self._X[:] = self._X_tmp
+
+        np.dot(self.f, self.p, out=self._p_tmp)
+        np.dot(self._p_tmp, self.fT, out=self.p)
+        self.p += self.q
+
+    def update(self, z):
+        """
+        Update the state with the measurement z, of shape (input_dim,).
+
+        y = z - H x
+        K = P H' / (H P H' + r)
+        x = x + K y
+        P = (I - K H) P (I - K H)' + r K K'
+        """
+        np.subtract(z, self._X[:, 0], out=self.y)
+        np.divide(self.p[:, 0], self.p[0, 0] + self.r_var, out=self.k)
+
+        np.multiply.outer(self.y, self.k, out=self._X_tmp)
+        self._X += self._X_tmp
+
+        self._i_kh[:] = self._I
+        self._i_kh[:, 0] -= self.k
+        np.dot(self._i_kh, self.p, out=self._p_tmp)
+        np.dot(self._p_tmp, self._i_kh.T, out=self.p)
+        np.multiply.outer(self.k, self.k, out=self._kk)
+        self._kk *= self.r_var
+        self.p += self._kk
+
+
+def transition_matrix(input_dim=2, num_terms=2, dt=1):
+    """
+    State transition matrix F of independent input dimensions, each with num_terms terms (position, velocity, ...)
+    """
     f = np.zeros((num_terms, num_terms), dtype=np.float)
     for i in range(num_terms):
         for j in range(i, num_terms):
             p = j - i
             f[i, j] = (dt ** p) / max(1, p)
 
-    kf.F = block_diag(*([f] * input_dim))
+    return block_diag(*([f] * input_dim))
+
 
-    # measurement function
+def measurement_matrix(input_dim=2, num_terms=2):
+    """
+    Measurement function H, which takes the position term of each input dimension
+    """
     h_block = np.zeros(num_terms, dtype=np.float)
     h_block[0] = 1.0
-    kf.H = block_diag(*([h_block] * input_dim))
-
-    kf.P *= 1.0  # covariance matrix
-    kf.R *= r_var  # measurement noise variance
+    return block_diag(*([h_block] * input_dim))
 
-    # process noise covariance matrix
-    q = Q_discrete_white_noise(dim=num_terms, dt=dt, var=q_var)
-    kf.Q = block_diag(*([q] * input_dim))
 
-    return kf
+def forecast_matrix(forecast_horizon, input_dim=2, num_terms=2, dt=1):
+    """
+    Matrix of the stacked projections H * F^t for t = 0..forecast_horizon-1. Multiplying it by a state vector
+    gives the positions of the whole forecast at once, with shape (forecast_horizon * input_dim,).
+    """
+    f = transition_matrix(input_dim, num_terms, dt)
+    h = measurement_matrix(input_dim, num_terms)
+    projections = np.empty((forecast_horizon, input_dim, input_dim * num_terms))
+    f_power = np.eye(input_dim * num_terms)
+    for t in range(forecast_horizon):
+        projections[t] = h @ f_power
+        f_power = f @ f_power
+    return projections.reshape(forecast_horizon * input_dim, input_dim * num_terms)
 
 
 class KalmanPredictor(TrajectoryPredictor):
     """
     A TrajectoryPredictor that uses a Kalman filter to predict future coordinates.
 
-    The predictor uses two kalman filters, one for each corner of the detected bounding box. This prevents dependence
-    between the state coordinates of the filter.
+    The predictor uses a single kalman filter over the 4 coordinates of the bounding box corners. The coordinates are
+    independent dimensions of the filter (all the matrices are block diagonal), so there's no dependence between the
+    state coordinates of the filter.
 
-    Predictions are made by recursively applying the state transition matrix F on the state vector x for each time step.
-    That is, the prediction at time t0 for time step t0 + t is: (F ** t) * x
+    Predictions are made by applying powers of the state transition matrix F on the state vector x for each time step.
+    That is, the prediction at time t0 for time step t0 + t is: (F ** t) * x. The projections H * (F ** t) for the
+    whole forecast horizon are precomputed, so a forecast is a single matrix-vector product.
 
     """
 
@@ -86,6 +259,8 @@ class KalmanPredictor(TrajectoryPredictor):
         self.num_terms = num_derivatives + 1
         self.q_var = q_var
         self.r_var = r_var
+        self.forecast_matrix = forecast_matrix(forecast_horizon, input_dim=4, num_terms=self.num_terms)
+        self.kf = create_light_kalman_filter(input_dim=4, num_terms=self.num_terms, q_var=q_var, r_var=r_var)
 
         self.discontinuity = False
 
@@ -100,27 +275,10 @@ class KalmanPredictor(TrajectoryPredictor):
         """
         self.discontinuity = False
 
-        init_x1 = np.zeros(2 * self.num_terms, np.float)
-        init_x1[0 :: self.num_terms] = detection[:2]  # x1y1
-
-        init_x2 = np.zeros(2 * self.num_terms, np.float)
-        init_x2[0 :: self.num_terms] = detection[2:4]  # x2y2
+        init_x = np.zeros(4 * self.num_terms, np.float)
+        init_x[0 :: self.num_terms] = detection[:4]  # x1y1x2y2
 
-        self.kf1 = create_kalman_filter(
-            init_x=init_x1,
-            input_dim=2,
-            num_terms=self.num_terms,
-            q_var=self.q_var,
-            r_var=self.r_var,
-        )
-
-        self.kf2 = create_kalman_filter(
-            init_x=init_x2,
-            input_dim=2,
-            num_terms=self.num_terms,
-            q_var=self.q_var,
-            r_var=self.r_var,
-        )
+        self.kf.reset(init_x)
 
     def _update_and_predict(self, past_input):
         """
@@ -136,63 +294,185 @@ class KalmanPredictor(TrajectoryPredictor):
                 # Reinitialize trajectory after a discontinuity (a sequence of NaNs has ended)
                 self.init_trajectory(past_input[-1])
             else:
-                # Update the filters according to the new measurement
-                self.kf1.predict()
-                self.kf2.predict()
-
-                self.kf1.update(past_input[-1, :2])
-                self.kf2.update(past_input[-1, 2:])
+                # Update the filter according to the new measurement
+                self.kf.predict()
+                self.kf.update(past_input[-1, :4])
         else:
             self.discontinuity = True
 
         # Generate a trajectory forecast
-        forecast = np.empty((self.forecast_horizon, 4), np.float)
-        pred1 = self.kf1.x
-        pred2 = self.kf2.x
-
-        for i in range(self.forecast_horizon):
-            forecast[i] = np.concatenate(
-                (pred1[0 :: self.num_terms], pred2[0 :: self.num_terms])
-            )
-            pred1 = np.dot(self.kf1.F, pred1)
-            pred2 = np.dot(self.kf2.F, pred2)
-
-        return forecast
-
-
-def filter_trial(df, cols=["x1", "y1"], q_var=2.145, r_var=120.0):
-    discontinuity = True
-    kf = None
-    values = df[cols].values
-
-    def init_trajectory(p):
-        nonlocal kf
-        init_x = np.zeros(4, np.float)
-        init_x[0::2] = p
-
-        kf = create_kalman_filter(
-            init_x=init_x, input_dim=2, num_terms=2, q_var=q_var, r_var=r_var,
-        )
-
-    def filter_point(p):
-        nonlocal discontinuity
-        if not np.isnan(p[0]):
-            if discontinuity:
-                # Reinitialize trajectory after a discontinuity (a sequence of NaNs has ended)
-                init_trajectory(p)
-                discontinuity = False
-            else:
-                # Update the filters according to the new measurement
-                kf.predict()
-                kf.update(p)
+        return (self.forecast_matrix @ self.kf.x).reshape(self.forecast_horizon, 4)
 
-            return kf.x[::2]
-        else:
-            discontinuity = True
-            return np.nan
 
-    filtered = np.empty_like(values)
-    for i in range(values.shape[0]):
-        filtered[i] = filter_point(values[i])
+def filter_trial(df, cols=["x1", "y1"], q_var=2.145, r_var=120.0, smooth=False):
+    """
+    Filter the trajectory of a single trial. See batch_kalman_filter.
+
+    :param df: DataFrame of a single trial
+    :param cols: the coordinate columns to filter
+    :return: numpy array of the filtered coordinates, NaN in rows without a measurement
+    """
+    values = df[cols].values.astype(float)
+    return batch_kalman_filter(values[np.newaxis], q_var=q_var, r_var=r_var, smooth=smooth)[0]
+
+
+def filter_trials(df, cols=["x1", "y1"], q_var=2.145, r_var=120.0, smooth=False):
+    """
+    Filter the trajectories of all the trials of a DataFrame at once. The trials are identified by the index of the
+    DataFrame (e.g. the trials DataFrame of the whole dataset), and the rows of each trial are assumed to be ordered
+    by time. The trials are stacked along a batch axis, padded with NaNs to the length of the longest trial, and
+    filtered together with batch_kalman_filter.
+
+    :param df: DataFrame indexed by trial
+    :param cols: the coordinate columns to filter
+    :return: numpy array of the filtered coordinates aligned with the rows of df, NaN in rows without a measurement
+    """
+    values = df[cols].values.astype(float)
+    _, codes = np.unique(df.index.values, return_inverse=True)
+    codes = codes.reshape(-1)
+
+    # position of each row inside its trial
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes)
+    steps = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    padded = np.full((len(counts), counts.max(), len(cols)), np.nan)
+    padded[codes[order], steps] = values[order]
+    filtered_padded = batch_kalman_filter(padded, q_var=q_var, r_var=r_var, smooth=smooth)
 
+    filtered = np.empty_like(values)
+    filtered[order] = filtered_padded[codes[order], steps]
     return filtered
+
+
+def batch_kalman_filter(values, num_terms=2, dt=1, q_var=2.145, r_var=120.0, smooth=False):
+    """
+    Filter many trajectories at once with the filter of create_light_kalman_filter, vectorized over the trajectories.
+
+    Each trajectory is filtered like a single LightKalmanFilter would: the filter is initialized on the first
+    measurement (position = measurement, other terms = 0, P = I), is predicted and updated by every following
+    measurement, and is reinitialized on the first measurement after a sequence of NaNs. Since a step is an update
+    exactly when the previous step has a measurement, the update and reinit masks of all the trajectories are computed
+    up front, and only the time steps are iterated.
+
+    With smooth=True a Rauch-Tung-Striebel smoother pass runs backwards over every continuous segment of the
+    filtered trajectories, and the smoothed positions are returned instead.
+
+    :param values: numpy array of shape (num_trajectories, num_steps, input_dim) of the measured coordinates,
+    NaN where there is no measurement (including the padding of shorter trajectories)
+    :param num_terms: number of terms in the dynamic system (2 for constant velocity, 3 for constant accel, etc.)
+    :param dt: time step
+    :param q_var: variance of process white noise
+    :param r_var: variance of measurement noise
+    :param smooth: run an RTS smoother pass after the filter
+    :return: numpy array of the filtered positions, same shape as values, NaN where values has no measurement
+    """
+    values = np.asarray(values, dtype=float)
+    num_batch, num_steps, input_dim = values.shape
+    f = transition_matrix(1, num_terms, dt)
+    q = white_noise_covariance(num_terms, dt, q_var)
+    eye = np.eye(num_terms)
+
+    valid = ~np.isnan(values[..., 0])
+    updated = np.zeros_like(valid)
+    updated[:, 1:] = valid[:, 1:] & valid[:, :-1]
+    reinit = valid & ~updated
+
+    # state of every trajectory as (input_dim, num_terms) and one covariance block per trajectory
+    x = np.zeros((num_batch, input_dim, num_terms))
+    p = np.tile(eye, (num_batch, 1, 1))
+    init_x = np.zeros_like(x)
+    i_kh = np.empty_like(p)
+    filtered = np.full_like(values, np.nan)
+    if smooth:
+        xs = np.empty((num_batch, num_steps, input_dim, num_terms))
+        ps = np.empty((num_batch, num_steps, num_terms, num_terms))
+
+    for t in range(num_steps):
+        z = values[:, t]
+        upd = updated[:, t]
+        if upd.any():
+            # predict
+            xu = x @ f.T
+            pu = f @ p @ f.T + q
+            # update, with a scalar innovation covariance per trajectory
+            y = z - xu[..., 0]
+            k = pu[:, :, 0] / (pu[:, 0, 0] + r_var)[:, np.newaxis]
+            xu += y[:, :, np.newaxis] * k[:, np.newaxis, :]
+            i_kh[:] = eye
+            i_kh[:, :, 0] -= k
+            pu = i_kh @ pu @ i_kh.transpose(0, 2, 1) + r_var * k[:, :, np.newaxis] * k[:, np.newaxis, :]
+
+            x = np.where(upd[:, np.newaxis, np.newaxis], xu, x)
+            p = np.where(upd[:, np.newaxis, np.newaxis], pu, p)
+
+        ini = reinit[:, t]
+        if ini.any():
+            init_x[..., 0] = z
+            x = np.where(ini[:, np.newaxis, np.newaxis], init_x, x)
+            p = np.where(ini[:, np.newaxis, np.newaxis], eye, p)
+
+        if smooth:
+            xs[:, t] = x
+            ps[:, t] = p
+        else:
+            filtered[valid[:, t], t] = x[valid[:, t], :, 0]
+
+    if not smooth:
+        return filtered
+
+    # RTS smoother. A step is smoothed from the next step only if the next step was predicted from it.
+    xs_smooth = xs.copy()
+    ps_smooth = ps.copy()
+    for t in range(num_steps - 2, -1, -1):
+        link = updated[:, t + 1]
+        if not link.any():
+            continue
+        pp = f @ ps[:, t] @ f.T + q
+        gain = ps[:, t] @ f.T @ np.linalg.inv(pp)
+        x_new = xs[:, t] + (xs_smooth[:, t + 1] - xs[:, t] @ f.T) @ gain.transpose(0, 2, 1)
+        p_new = ps[:, t] + gain @ (ps_smooth[:, t + 1] - pp) @ gain.transpose(0, 2, 1)
+        xs_smooth[:, t] = np.where(link[:, np.newaxis, np.newaxis], x_new, xs_smooth[:, t])
+        ps_smooth[:, t] = np.where(link[:, np.newaxis, np.newaxis], p_new, ps_smooth[:, t])
+
+    return np.where(valid[..., np.newaxis], xs_smooth[..., 0], np.nan)
+
+
+def benchmark_filterpy(num_steps=10000, input_dim=4, num_terms=2, q_var=0.01, r_var=5.0, seed=0):
+    """
+    Run LightKalmanFilter and filterpy's KalmanFilter on the same random walk measurements, and compare their
+    results and running times.
+
+    :param num_steps: number of predict-update steps
+    :param input_dim: dimensions of input
+    :param num_terms: number of terms in the dynamic system
+    :param q_var: variance of process white noise matrix Q
+    :param r_var: variance of measurement noise matrix R
+    :param seed: seed of the random measurements
+    :return: dict with the maximal absolute differences of the state vectors and covariances, and the running
+    time of each filter in seconds
+    """
+    rng = np.random.default_rng(seed)
+    measurements = np.cumsum(rng.normal(scale=3.0, size=(num_steps, input_dim)), axis=0)
+    init_x = np.zeros(input_dim * num_terms)
+    init_x[0::num_terms] = measurements[0]
+
+    fp = create_kalman_filter(init_x=init_x.copy(), input_dim=input_dim, num_terms=num_terms, q_var=q_var, r_var=r_var)
+    light = create_light_kalman_filter(init_x=init_x, input_dim=input_dim, num_terms=num_terms, q_var=q_var, r_var=r_var)
+
+    results = {}
+    states = {}
+    for name, kf in [('filterpy', fp), ('light', light)]:
+        xs = np.empty((num_steps, input_dim * num_terms))
+        t0 = time.perf_counter()
+        for i in range(num_steps):
+            kf.predict()
+            kf.update(measurements[i])
+            xs[i] = kf.x
+        results[f'{name}_time'] = time.perf_counter() - t0
+        states[name] = xs, kf.P.copy()
+
+    results['max_x_diff'] = np.abs(states['filterpy'][0] - states['light'][0]).max()
+    results['max_P_diff'] = np.abs(states['filterpy'][1] - states['light'][1]).max()
+    results['speedup'] = results['filterpy_time'] / results['light_time']
+    return results
@@ -11,12 +11,119 @@ TrajectoryPredictor - An abstract trajectory predictor class. This class receive
 from Prediction.detector import nearest_detection, xyxy_to_centroid
 from Prediction import calibration as calib
 from Prediction import detector
+from Prediction.records import RecordsWriter
 import numpy as np
-import pandas as pd
+import time
 import logging
+import threading
 import config
+from frames import Frame
 
-_det = detector.Detector_v4(conf_thres=0.8)
+# the detector is shared by all HitPredictor instances, and created on first use (see get_detector)
+_det = None
+_det_lock = threading.Lock()
+_warmup_thread = None
+_warmup_lock = threading.Lock()  # guards _warmup_thread only, so warmup_detector never waits for _det_lock
+
+
+def get_detector():
+    """
+    Return the shared realtime detector, creating it on the first call. Loading the network takes a few seconds
+    and GPU memory, so it's deferred until a predictor actually needs it, or until warmup_detector is called.
+    The first (blank) inference runs before the detector is shared, so callers that wait for the detector while it
+    loads never run inference concurrently with the warm-up.
+    """
+    global _det
+    with _det_lock:
+        if _det is None:
+            if config.detector_backend == 'opencv':
+                det = detector.Detector_v4_cpu(conf_thres=0.8, num_threads=config.detector_threads)
+            else:
+                det = detector.Detector_v4(conf_thres=0.8)
+            try:
+                det.detect_image(np.zeros((det.model_height, det.model_width, 3), dtype=np.uint8))
+            except Exception as exc:
+                print(f'Error in detector warm-up: {exc}')
+            _det = det
+    return _det
+
+
+def warmup_detector():
+    """
+    Create the shared detector and run a first inference in a background thread, e.g. while the cameras initialise.
+    Does nothing if the detector exists or is already warming up.
+    """
+    global _warmup_thread
+    if _det is not None:
+        return
+    with _warmup_lock:
+        if _warmup_thread is not None and _warmup_thread.is_alive():
+            return
+
+        def _warmup():
+            try:
+                get_detector()
+            except Exception as exc:
+                print(f'Error in detector warm-up: {exc}')
+
+        _warmup_thread = threading.Thread(target=_warmup, name='detector-warmup', daemon=True)
+        _warmup_thread.start()
+
+
+class DetectionHistory:
+    """
+    Ring buffer of the detections of the last frames, one xyxy row per frame (NaN when there was no detection).
+    The rows are appended to a binary records file (see records.py) in chunks before they are overwritten.
+    """
+
+    def __init__(self, size, path=None):
+        """
+        :param size: number of rows in the ring buffer.
+        :param path: records file path for the history rows. The rows are discarded when they leave the buffer
+                     if None.
+        """
+        self.size = size
+        self.path = path
+        self.rows = np.full((size, 4), np.nan)
+        self.times = np.full(size, np.nan)
+        self.num_rows = 0  # number of rows appended since the beginning
+        self.num_saved = 0  # number of rows written to the file
+        self.writer = None
+
+    def __len__(self):
+        return self.num_rows
+
+    def append(self, detection):
+        """Add the detection of the next frame, or None if there was no detection"""
+        if self.num_rows - self.num_saved == self.size:
+            self.save()
+        idx = self.num_rows % self.size
+        self.rows[idx] = np.nan if detection is None else detection[:4]
+        self.times[idx] = time.time()
+        self.num_rows += 1
+
+    def last(self, n=None):
+        """Return the last n rows in chronological order (default all the rows in the buffer)"""
+        return self.rows[self.last_indices(n)]
+
+    def last_indices(self, n=None):
+        n = min(n or self.size, self.size, self.num_rows)
+        return np.arange(self.num_rows - n, self.num_rows) % self.size
+
+    def save(self):
+        """Write the rows that were not written yet"""
+        if self.num_saved == self.num_rows:
+            return
+        if self.path:
+            if self.writer is None:
+                self.writer = RecordsWriter(self.path, "bbox", (4,))
+            idx = self.last_indices(self.num_rows - self.num_saved)
+            self.writer.write(np.arange(self.num_saved, self.num_rows), self.times[idx], self.rows[idx])
+        self.num_saved = self.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
 
 class HitPredictor:
@@ -34,11 +141,9 @@ class HitPredictor:
     A hit is predicted when the bottom edge of the bounding box passes a certain y-coordinate threshold
     (prediction_y_threshold attribute).
 
-    All trajectory forecasts are stored in the forecasts attribute (a list of forecast arrays) for later
-    analysis if necessary.
-
-    The history array grows dynamically as new frames are processed. The reset() method clears the history
-    and should be used to prevent excess memory usage when running for a long time.
+    The detections history is a fixed size ring buffer (DetectionHistory), and the trajectory forecasts are
+    kept in the forecasts attribute until a chunk of them is complete. When dir_path is set, both are written
+    to disk in chunks while running, so memory usage stays bounded on long trials.
     """
 
     def __init__(
@@ -49,38 +154,59 @@ class HitPredictor:
         prediction_y_threshold=0,
         y_thresh_above=False,
         dir_path='',
-        logger=None
+        logger=None,
+        roi_size=None,
+        roi_max_misses=5
     ):
         """
         Initialize HitPredictor.
         Load data from the last camera calibration, which can be overriden using the calibrate method.
 
         :param trajectory_predictor: an initialized TrajectoryPredictor
-        :param detector: an initialized Pogona head object Detector
-        :param history_size: initial size of the detections history array.
+        :param detector: an initialized Pogona head object Detector. If None, the shared detector of the module
+                         is used, and created on the first frame if it doesn't exist yet.
+        :param history_size: number of frames kept in the detections history ring buffer, and the number of
+                             forecasts written to disk at once.
         :param prediction_y_threshold: y-coordinate threshold for a screen hit relative to the screen coordinate system.
         :param y_thresh_above: boolean indicating whether the threshold is crossed from below or above.
+        :param roi_size: minimal height in pixels of the region of interest around the last detection, in which the
+                         detector runs instead of the full frame. None disables the region of interest mode.
+        :param roi_max_misses: number of consecutive frames without detection in the region of interest,
+                               after which the detector goes back to the full frame.
         """
 
         # look for last homography in some folder and load it. maybe also save dims
         self.homography, cam_width, cam_height = calib.get_last_homography()
+        self.camera_matrix = None
+        self.corrector = None
         if self.homography is not None:
             _, _, self.camera_matrix = calib.get_undistort_mapping(
                 cam_width, cam_height
             )
+            frame_size = (cam_width, cam_height) if config.is_undistort_lookup else None
+            self.corrector = calib.DetectionCorrector(self.homography, self.camera_matrix, frame_size=frame_size)
 
         self.trajectory_predictor = trajectory_predictor
-        self.detector = detector if detector is not None else _det
+        self._detector = detector
         self.prediction_y_threshold = prediction_y_threshold
         self.y_thresh_above = y_thresh_above
         self.dir_path = dir_path
         self.logger = logger or logging.getLogger(__file__)
+        self.roi_size = roi_size
+        self.roi_max_misses = roi_max_misses
 
         self.reset(history_size=history_size)
 
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = get_detector()
+        return self._detector
+
     def handle_frame(self, frame):
         """
         Process a single video frame, update trajectory forecast and predict screen touches (hits).
+        The frame is either a BGR numpy image or a Frame object shared with the recorder.
         See handle_detection for returned values.
         """
         if self.frame_num == 0:
@@ -117,7 +243,7 @@ class HitPredictor:
         else:
             # Update trajectory predictor.
             forecast = self.trajectory_predictor.update_and_predict(
-                self.history[: self.frame_num + 1]
+                self.history.last(self.trajectory_predictor.input_len)
             )
             if forecast is not None:
                 hit_point, hit_steps = self.predict_hit(forecast)
@@ -126,7 +252,7 @@ class HitPredictor:
             forecast, hit_point, hit_steps = detection, np.array([0, 0, 0, 0]), 1
 
         self.frame_num += 1
-        self.forecasts.append(forecast)
+        self.add_forecast(forecast)
 
         return forecast, hit_point, hit_steps
 
@@ -143,11 +269,7 @@ class HitPredictor:
                 "HitPredictor has no homography configured"
             )
 
-        x1y1 = calib.undistort_point(detection[:2], self.camera_matrix)
-        x2y2 = calib.undistort_point(detection[2:4], self.camera_matrix)
-        x1y1 = calib.transform_point(x1y1, self.homography)
-        x2y2 = calib.transform_point(x2y2, self.homography)
-        return np.concatenate([x1y1, x2y2])
+        return self.corrector.correct(detection)
 
     def detect_pogona_head(self, frame):
         """
@@ -155,15 +277,17 @@ class HitPredictor:
         Return a single best candidate detection or None if there was no detection.
         """
         if self.detector is not None:
-            detections = self.detector.detect_image(frame)
+            detections = self.detect_image(frame)
         else:
             detections = None
         if detections is not None:
-            if len(self.history) > 0:
-                prev_centroid = xyxy_to_centroid(self.history[-1])
+            if self.last_raw_detection is not None:
+                # compare in camera coordinates, as the history holds corrected detections
+                prev_centroid = xyxy_to_centroid(self.last_raw_detection)
                 detection = nearest_detection(detections, prev_centroid)
             else:
                 detection = detections[0]
+            self.last_raw_detection = detection
             if self.camera_matrix is not None and self.homography is not None:
                 detection = self.correct_detection(detection)
         else:
@@ -171,6 +295,56 @@ class HitPredictor:
 
         return detection
 
+    def detect_image(self, frame):
+        """
+        Run the detector on the region of interest around the last detection when the ROI mode is on and
+        there is a recent detection, or on the whole frame otherwise.
+        Return the detections in the coordinates of the full frame.
+        """
+        roi = self.get_roi(frame.shape)
+        if roi is None:
+            self.roi_misses = 0
+            return self.detector.detect_image(frame)
+
+        x0, y0, x1, y1 = roi
+        if isinstance(frame, Frame):
+            crop = frame.crop(x0, y0, x1, y1)
+        else:
+            crop = frame[y0:y1, x0:x1]
+        detections = self.detector.detect_image(crop)
+        if detections is None:
+            self.roi_misses += 1
+            if self.roi_misses >= self.roi_max_misses:
+                self.last_raw_detection = None  # back to full frame search
+                self.roi_misses = 0
+            return None
+
+        self.roi_misses = 0
+        return detections + np.array([x0, y0, x0, y0, 0])
+
+    def get_roi(self, frame_shape):
+        """
+        Region of interest centered on the last detection (in camera coordinates), with the aspect ratio of the
+        frame, so the detector sees the animal in the same proportions as in the full frame.
+        Return (x0, y0, x1, y1), or None if the detector should run on the whole frame.
+        """
+        if self.roi_size is None or self.last_raw_detection is None:
+            return None
+
+        frame_height, frame_width = frame_shape[:2]
+        x1, y1, x2, y2 = self.last_raw_detection[:4]
+        aspect = frame_width / frame_height
+        roi_height = max(self.roi_size, 2 * (y2 - y1), 2 * (x2 - x1) / aspect)
+        roi_width = roi_height * aspect
+        if roi_height >= frame_height or roi_width >= frame_width:
+            return None
+
+        roi_height, roi_width = int(roi_height), int(roi_width)
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        x0 = int(np.clip(cx - roi_width / 2, 0, frame_width - roi_width))
+        y0 = int(np.clip(cy - roi_height / 2, 0, frame_height - roi_height))
+        return x0, y0, x0 + roi_width, y0 + roi_height
+
     def predict_hit(self, forecast):
         """
         Predict when and where the pogona will hit the screen.
@@ -198,39 +372,101 @@ class HitPredictor:
 
     def update_history(self, detection):
         """
-        Add detection to history, and double the history size if necessary.
+        Add detection (or None) to history as the row of the current frame.
+        """
+        self.history.append(detection)
+
+    def add_forecast(self, forecast):
+        """
+        Add the forecast (or None) of the current frame, and write the forecasts to disk when a chunk is complete.
         """
-        history_size = self.history.shape[0]
-        if self.frame_num >= history_size:
-            new_hist = np.empty((history_size, 4), np.float)
-            new_hist[:] = np.nan
+        self.forecasts.append(forecast)
+        self.forecast_times.append(time.time())
+        if len(self.forecasts) >= self.history.size:
+            self.save_forecasts()
 
-            self.history = np.vstack((self.history, new_hist))
+    def save_forecasts(self):
+        """
+        Append the forecasts that were not written yet to the forecasts records file. Frames without a forecast
+        are written as NaN records. The shape of the records is (forecast_horizon, 4) of the trajectory predictor,
+        or the shape of the first forecast when there's no trajectory predictor. Until the shape is known, the
+        (empty) forecasts are not written.
+        Forecasts of a different shape (the detections that replace the forecasts in predictor experiment mode) are
+        written as NaN records as well. The detections themselves are kept in the detections history.
+        """
+        if self.dir_path:
+            if self.forecasts_writer is None:
+                if self.trajectory_predictor is not None:
+                    shape = (self.trajectory_predictor.forecast_horizon, 4)
+                else:
+                    shape = next((np.shape(f) for f in self.forecasts if f is not None), None)
+                if shape is not None:
+                    self.forecasts_writer = RecordsWriter(self.predictions_path, "forecast", shape)
+
+            if self.forecasts_writer is not None and self.forecasts:
+                shape = self.forecasts_writer.dtype["forecast"].shape
+                data = np.full((len(self.forecasts), *shape), np.nan, dtype=np.float32)
+                num_mismatched = 0
+                for i, forecast in enumerate(self.forecasts):
+                    if forecast is None:
+                        continue
+                    if np.shape(forecast) != shape:
+                        num_mismatched += 1
+                        continue
+                    data[i] = forecast
+                if num_mismatched and not config.is_predictor_experiment:
+                    self.logger.warning(f'{num_mismatched} forecasts with a shape other than {shape} '
+                                        f'were saved as NaN')
+                frames = np.arange(self.num_saved_forecasts, self.num_saved_forecasts + len(self.forecasts))
+                self.forecasts_writer.write(frames, self.forecast_times, data)
+
+        self.num_saved_forecasts += len(self.forecasts)
+        self.forecasts = []
+        self.forecast_times = []
 
-        if detection is not None:
-            self.history[self.frame_num] = detection[:4]
+    def skip_frames(self, num_frames):
+        """
+        Account for frames that were not processed (e.g. dropped by an asynchronous predictor), so the history
+        keeps a row for every camera frame. Each skipped frame is handled as a frame without a detection, so the
+        trajectory predictor advances one time step per camera frame (filling its input from the last forecast),
+        and the velocities and hit steps of the next forecasts stay in camera frame units.
+        """
+        for _ in range(num_frames):
+            self.handle_detection(None)
 
     def reset(self, history_size=512):
         """
-        Revert HitPredictor to its initialized state. Clears history and forecasts arrays.
+        Revert HitPredictor to its initialized state. Clears history and forecasts, without writing the
+        ones that were not written yet.
         """
+        if getattr(self, 'history', None) is not None:
+            self.history.close()
+        if getattr(self, 'forecasts_writer', None) is not None:
+            self.forecasts_writer.close()
         self.frame_num = 0
         self.did_find_detections = False
-        self.history = np.empty((history_size, 4), np.float)
-        self.history[:] = np.nan
-        self.forecasts = []
+        self.last_raw_detection = None  # last detection in camera coordinates, the center of the ROI
+        self.roi_misses = 0
+        self.history = DetectionHistory(history_size, self.predictor_history_path if self.dir_path else None)
+        self.forecasts = []  # forecasts that were not written yet
+        self.forecast_times = []
+        self.num_saved_forecasts = 0
+        self.forecasts_writer = None
 
     def save_predictions(self):
-        pd.Series(self.forecasts).to_csv(self.predictions_path)
-        pd.DataFrame(self.history).to_csv(self.predictor_history_path)
+        """
+        Write the remaining forecasts and history rows.
+        """
+        self.save_forecasts()
+        self.history.save()
 
     @property
     def predictions_path(self):
-        return f'{self.dir_path}/forecasts.csv'
+        return f'{self.dir_path}/forecasts.bin'
 
     @property
     def predictor_history_path(self):
-        return f'{self.dir_path}/predictor_history.csv'
+        return f'{self.dir_path}/predictor_history.bin'
 
 
 class TrajectoryPredictor:
@@ -311,4 +547,6 @@ class TrajectoryPredictor:
 
 
 def gen_hit_predictor(logger, dir_path):
-    return HitPredictor(None, logger=logger, dir_path=dir_path)
+    roi_size = config.predictor_roi_size if config.is_predictor_roi else None
+    return HitPredictor(None, logger=logger, dir_path=dir_path, roi_size=roi_size,
+                        roi_max_misses=config.predictor_roi_max_misses)
@@ -0,0 +1,84 @@
+"""
+This module is responsible for the binary files in which the real-time predictor stores its detections history and
+trajectory forecasts while a trial runs.
+
+A records file is a flat sequence of fixed-size records of a numpy structured dtype, so new records are simply
+appended to the end of the file, and the file can be memory-mapped as a numpy array for analysis. The dtype is
+described in a JSON sidecar file next to the records file (same name with a .json suffix).
+Each record holds the frame index, the server time in which the record was created, and the data array.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+RECORDS_VERSION = 1
+
+
+def records_dtype(data_field, data_shape):
+    """
+    :param data_field: str, name of the data field (e.g. "bbox", "forecast")
+    :param data_shape: tuple, shape of the data array of each record
+    :return: numpy structured dtype of the records
+    """
+    return np.dtype([("frame", "<i8"), ("time", "<f8"), (data_field, "<f4", tuple(data_shape))])
+
+
+def sidecar_path(path):
+    return Path(path).with_suffix(".json")
+
+
+class RecordsWriter:
+    """
+    Appends records to a binary records file, creating the file and its JSON sidecar on initialization.
+    """
+
+    def __init__(self, path, data_field, data_shape):
+        """
+        :param path: path of the records file
+        :param data_field: str, name of the data field
+        :param data_shape: tuple, shape of the data array of each record
+        """
+        self.path = Path(path)
+        self.data_field = data_field
+        self.dtype = records_dtype(data_field, data_shape)
+        with open(sidecar_path(path), "w") as f:
+            json.dump({"version": RECORDS_VERSION, "data_field": data_field, "data_shape": list(data_shape)}, f)
+        self.file = open(self.path, "wb")
+
+    def write(self, frames, times, data):
+        """
+        Append records.
+
+        :param frames: sequence of frame indices
+        :param times: sequence of server times
+        :param data: numpy array of shape (number of records, *data_shape)
+        """
+        records = np.empty(len(frames), dtype=self.dtype)
+        records["frame"] = frames
+        records["time"] = times
+        records[self.data_field] = data
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_records(path):
+    """
+    Memory-map a records file.
+    A partial record at the end of the file (e.g. from a crash while writing) is ignored.
+
+    :param path: path of the records file
+    :return: numpy structured array (read-only memmap) of the records
+    """
+    with open(sidecar_path(path), "r") as f:
+        meta = json.load(f)
+    dtype = records_dtype(meta["data_field"], meta["data_shape"])
+
+    num_records = Path(path).stat().st_size // dtype.itemsize
+    if num_records == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(num_records,))
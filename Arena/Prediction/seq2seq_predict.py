@@ -6,17 +6,39 @@ Seq2SeqPredictor - A TrajectoryPredictor subclass that uses a pytorch model for
 TrajEncDec - A pytorch model that uses an encoder-decoder seq2seq architechture to predict trjaectories based on past trajectories.
 """
 
+import os
+import numpy as np
 import torch
 from torch import nn
+import config
 from Prediction.predictor import TrajectoryPredictor
 
 
+def get_exported_path(weights_path):
+    """
+    Return the path of the exported TorchScript model of a weights file (see traj_models.export_model).
+    """
+    return os.path.splitext(weights_path)[0] + ".ts.pt"
+
+
 class Seq2SeqPredictor(TrajectoryPredictor):
     """
     A TrajectoryPredictor subclass that uses a pytorch model to generate trajectory forecasts.
+
+    In streaming mode (TrajEncDec models only) the encoder's hidden state is kept between frames, and each new
+    detection advances it by a single encoder step, instead of encoding the whole input_len window on every frame.
+    The window is encoded only when the stream starts, and again after a NaN gap in the input. Note that the
+    streaming encoder state summarizes the whole trajectory since the last gap, not only the last input_len
+    detections, so the forecasts are not identical to the non-streaming ones.
+
+    When an exported TorchScript model of the weights file exists (see traj_models.export_model), it's used instead
+    of the eager model for the window predictions. Streaming mode always uses the eager model, since it runs the
+    encoder and decoder separately. The exported model is frozen and optimized for CPU inference (and may be
+    quantized), so it always runs on the CPU.
     """
 
-    def __init__(self, model, weights_path, input_len, forecast_horizon):
+    def __init__(self, model, weights_path, input_len, forecast_horizon, streaming=False, use_exported=True,
+                 num_threads=config.predictor_torch_threads):
         """
         The model is sent to the available device, and weights are loaded from the file.
 
@@ -24,31 +46,87 @@ class Seq2SeqPredictor(TrajectoryPredictor):
         :param weights_path: Path to a pickled state dictionary containing trained weights for the model.
         :param input_len: Number of timesteps to look back in order to generate a forecast.
         :param forecast_horizon: The forecast size in timesteps into the future.
+        :param streaming: Boolean, whether to keep the encoder state between frames (see class docstring).
+        :param use_exported: Boolean, whether to load the exported TorchScript model of the weights when it exists.
+        :param num_threads: Number of torch CPU threads, or 0 to keep the torch default.
         """
         super().__init__(input_len, forecast_horizon)
 
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = model.to(self.device).float()
-        self.model.load_state_dict(torch.load(weights_path))
+        exported_path = get_exported_path(weights_path)
+        if use_exported and not streaming and os.path.exists(exported_path):
+            self.device = torch.device("cpu")
+            self.model = torch.jit.load(exported_path, map_location="cpu")
+            self.is_exported = True
+        else:
+            self.model = model.to(self.device).float()
+            self.model.load_state_dict(torch.load(weights_path, map_location=self.device))
+            self.is_exported = False
         self.model.eval()
 
+        self.streaming = streaming
+        self.stream_state = None
+
     def init_trajectory(self, detection):
         """
         No need to initialize trjaectory as this model is only concerned with the past input_len detections.
+        In streaming mode, the encoder state is reset and the next full window will be encoded again.
         """
-        pass
+        self.stream_state = None
 
     def _update_and_predict(self, past_input):
         """
         Receive an updated bbox trajectory of the last input_len time steps, and generate and return a forecast
         trajectory by passing it as input to the model.
         """
-        with torch.no_grad():
+        if self.streaming:
+            return self._stream_predict(past_input)
+
+        with torch.inference_mode():
             inp = torch.from_numpy(past_input).to(self.device)
             inp = inp.unsqueeze(0).float()  # Adds an additional dimension for a batch size of 1.
             forecast = self.model(inp)
             return forecast.squeeze().cpu().numpy()
 
+    def _stream_predict(self, past_input):
+        """
+        Streaming version of _update_and_predict. The stream state is a tuple of the encoder states (hn, cn),
+        the encoder features that were not encoded yet (the RNN decoder's first input), and the last two positions.
+        """
+        if np.isnan(past_input[-1, 0]) or (self.stream_state is None and np.isnan(past_input).any()):
+            # a gap in the trajectory, the window is encoded again once it's full of detections.
+            self.stream_state = None
+            return np.full((self.forecast_horizon, 4), np.nan)
+
+        with torch.inference_mode():
+            if self.stream_state is None:
+                inp = torch.from_numpy(past_input).to(self.device).float().unsqueeze(0)
+                input_vels = inp[:, 1:] - inp[:, :-1]
+                input_en = self.model.encoder_input(inp, input_vels)
+                num_pending = 1 if self.model.decoder_type == "RNN" else 0
+                hn, cn = self.model.encode(input_en[:, : input_en.shape[1] - num_pending])
+                pending = input_en[:, input_en.shape[1] - num_pending:]
+                last_pos = inp[:, -2:]
+            else:
+                hn, cn, pending, last_pos = self.stream_state
+                pos = torch.from_numpy(past_input[-1:]).to(self.device).float().unsqueeze(0)
+                last_pos = torch.cat((last_pos[:, 1:], pos), dim=1)
+                input_vels = last_pos[:, 1:] - last_pos[:, :-1]
+                input_en = self.model.encoder_input(last_pos, input_vels)
+                if pending.shape[1] > 0:
+                    # the RNN decoder's first input from the previous frame is now an encoder input
+                    hn, cn = self.model.encode(pending, hn, cn)
+                    pending = input_en
+                else:
+                    hn, cn = self.model.encode(input_en, hn, cn)
+
+            self.stream_state = (hn, cn, pending, last_pos)
+            forecast = self.model.decode(hn, cn, last_pos, input_vels)
+            return forecast.squeeze().cpu().numpy()
+
 
 class TrajEncDec(nn.Module):
     """
@@ -272,39 +350,69 @@ class TrajEncDec(nn.Module):
         # reshape the output into a sequence of bbox coordinates.
         return output.view(-1, self.output_seq_size, 4)
 
-    def forward(self, input_seq):
+    def encoder_input(self, input_seq, input_vels):
         """
-        Main forward function for the encoder-decoder module.
+        Return the encoder input features of a trajectory sequence.
 
-        :param input_seq: An input trajectory sequence tensor of size (batch size, sequence length, 4)
+        :param input_seq: module input sequence
+        :param input_vels: first difference of the input_seq
         """
-
-        # switch from absolute positions to velocity vectors.
-        offset = input_seq[:, -1][:, None, :]
-        input_vels = input_seq[:, 1:] - input_seq[:, :-1]
-
         if self.use_abs_pos:
             # encode both positions and velocities features.
-            input_en = torch.cat((input_seq[:, :-1], input_vels), dim=-1)
+            return torch.cat((input_seq[:, :-1], input_vels), dim=-1)
         else:
             # use only velocity vectors as input features.
-            input_en = input_vels
+            return input_vels
 
-        if self.decoder_type == "RNN":
-            input_en = input_en[:, :-1]  # up until and including v_{m-2}, v_{m-1} is the decoder's first input
-        input_en = self.dropout_layer(input_en)
+    def encode(self, input_en, hn=None, cn=None):
+        """
+        Run the encoder over a sequence of input features.
 
-        # encode input
+        :param input_en: encoder input features of size (batch size, sequence length, input size)
+        :param hn: hidden state to start from, or None for the initial state
+        :param cn: cell state to start from (LSTM only)
+        :return: (hn, cn), the encoder states after the last input. cn is None for a GRU.
+        """
         if self.rnn_type == "GRU":
-            _, hn = self.encoder(input_en)
+            _, hn = self.encoder(input_en, hn)
             cn = None
         else:
-            _, (hn, cn) = self.encoder(input_en)
+            _, (hn, cn) = self.encoder(input_en, None if hn is None else (hn, cn))
+        return hn, cn
 
-        # decode output
+    def decode(self, hn, cn, input_seq, input_vels):
+        """
+        Decode the encoder states into an output trajectory of absolute positions.
+
+        :param hn: the encoder's hidden state
+        :param cn: the encoder's cell state (LSTM only)
+        :param input_seq: module input sequence (only the last position is used, and the batch size)
+        :param input_vels: first difference of the input_seq (only the last velocity is used)
+        """
         if self.decoder_type == 'RNN':
             out = self.decoder_rnn(hn, cn, input_seq, input_vels)
         else:
             out = self.decoder_linear(hn)
 
-        return out.cumsum(dim=1) + offset
+        return out.cumsum(dim=1) + input_seq[:, -1][:, None, :]
+
+    def forward(self, input_seq):
+        """
+        Main forward function for the encoder-decoder module.
+
+        :param input_seq: An input trajectory sequence tensor of size (batch size, sequence length, 4)
+        """
+
+        # switch from absolute positions to velocity vectors.
+        input_vels = input_seq[:, 1:] - input_seq[:, :-1]
+        input_en = self.encoder_input(input_seq, input_vels)
+
+        if self.decoder_type == "RNN":
+            input_en = input_en[:, :-1]  # up until and including v_{m-2}, v_{m-1} is the decoder's first input
+        input_en = self.dropout_layer(input_en)
+
+        # encode input
+        hn, cn = self.encode(input_en)
+
+        # decode output
+        return self.decode(hn, cn, input_seq, input_vels)
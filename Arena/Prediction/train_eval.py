@@ -44,6 +44,36 @@ class TrajectoriesData(Dataset):
         return self.X[item], self.Y[item]
 
 
+def sliding_windows(data, window_size):
+    """
+    Return a read-only strided view of all the windows of consecutive rows of a 2D array.
+
+    :param data: 2D numpy array of shape (number of rows, number of features)
+    :param window_size: int, number of rows in each window
+    :return: numpy array view of shape (number of rows - window_size + 1, window_size, number of features)
+    """
+    num_windows = max(data.shape[0] - window_size + 1, 0)
+    return np.lib.stride_tricks.as_strided(
+        data,
+        shape=(num_windows, window_size, data.shape[1]),
+        strides=(data.strides[0], data.strides[0], data.strides[1]),
+        writeable=False,
+    )
+
+
+def nan_windows(data, window_size):
+    """
+    Return a boolean array that is True for each window of consecutive rows (see sliding_windows) that contains a
+    NaN value. Uses a cumulative sum of the rows with NaNs, instead of checking each window.
+
+    :param data: 2D numpy array of shape (number of rows, number of features)
+    :param window_size: int, number of rows in each window
+    :return: 1D boolean numpy array with an element for each window
+    """
+    nan_count = np.concatenate([[0], np.cumsum(np.isnan(data).any(axis=1))])
+    return (nan_count[window_size:] - nan_count[:-window_size]) > 0
+
+
 def trial_to_samples(
     trial_df,
     input_labels,
@@ -58,7 +88,7 @@ def trial_to_samples(
     (sample, input sequence index, single timestep dimension) and Y with dim
     (sample, output sequence index, single timestep dimension) using a sliding window
     Assumes that the data is corrected and transformed
-    Iteratively creates 3D tensors from trials and finally concatenates them into a single tensor.
+    The windows are strided views of the trial data, and only the windows that are kept are copied into X and Y.
     Note: will require large amounts of memeory, alongside the function collect_data from dataset.py, these functions
     need to be re-written to work with larger than memory data, or by loading only small masked subsets of the data.
 
@@ -72,28 +102,28 @@ def trial_to_samples(
     :return: tuple (X, Y), 3D tensors of sequences
     """
 
-    input_2d_arrays = []
-    output_2d_arrays = []
-
-    inds_range = trial_df.shape[0] - input_seq_size - output_seq_size + 1
+    num_windows = trial_df.shape[0] - input_seq_size - output_seq_size + 1
+    if num_windows <= 0:
+        return None, None
 
     input_data = trial_df[input_labels].values
-    output_data = trial_df[output_labels].values
+    output_data = trial_df[output_labels].values[input_seq_size:]
 
-    for i in range(inds_range):
-        inp_seq = input_data[i : i + input_seq_size]
-        out_seq = output_data[i + input_seq_size : i + input_seq_size + output_seq_size]
+    # read-only views of all the windows, nothing is copied yet
+    X = sliding_windows(input_data, input_seq_size)[:num_windows]
+    Y = sliding_windows(output_data, output_seq_size)[:num_windows]
 
-        if not keep_nans and (np.any(np.isnan(inp_seq)) or np.any(np.isnan(out_seq))):
-            continue
-
-        input_2d_arrays.append(inp_seq)
-        output_2d_arrays.append(out_seq)
-
-    if len(input_2d_arrays) == 0:
-        return None, None
-    X = np.stack(input_2d_arrays)
-    Y = np.stack(output_2d_arrays)
+    if keep_nans:
+        X = X.copy()
+        Y = Y.copy()
+    else:
+        keep = ~(nan_windows(input_data, input_seq_size)[:num_windows]
+                 | nan_windows(output_data, output_seq_size)[:num_windows])
+        if not keep.any():
+            return None, None
+        # only the kept windows are copied
+        X = X[keep]
+        Y = Y[keep]
 
     if mask_fn is not None:
         mask = mask_fn(X, Y)
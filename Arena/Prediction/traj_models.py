@@ -5,6 +5,7 @@ This module helps to manage a library of TrajEncDec models, and contains functio
 - Generate a module object using existing parameters.
 - Retrieve training and model parameters of exisiting models.
 - Plot the results of multiple training sessions.
+- Export trained models to TorchScript for the realtime predictor.
 """
 
 import os
@@ -13,6 +14,8 @@ from datetime import datetime
 import re
 import matplotlib.pyplot as plt
 import traceback
+import torch
+from torch import nn
 
 from Prediction import seq2seq_predict
 from Prediction import train_eval
@@ -44,6 +47,14 @@ def get_weights_path(model_name, suffix="best"):
     return os.path.join(WEIGHTS_DIR, f"{model_name}_{suffix}.pth")
 
 
+def get_exported_path(model_name, suffix="best"):
+    """
+    Return the path of an exported TorchScript model (see export_model). Seq2SeqPredictor loads it instead of the
+    eager model when it exists.
+    """
+    return seq2seq_predict.get_exported_path(get_weights_path(model_name, suffix))
+
+
 def get_models_dict():
     """
     Return the entire models dictionary, as read from the model parameters json file.
@@ -95,6 +106,61 @@ def get_model(model_name):
     return build_model(params["network_params"]), params
 
 
+def export_model(model_name, suffix="best", quantize=False, num_threads=None):
+    """
+    Export a trained model to a TorchScript file for CPU inference.
+
+    The model is traced with an input of its inp_seq_len, which unrolls the python loop of the RNN decoder into the
+    TorchScript graph. The traced model is then frozen and optimized for inference.
+    With quantize=True the model's RNN and linear layers are dynamically quantized to int8 before tracing,
+    which is faster on CPU at some cost of accuracy.
+
+    :param model_name: The model name as it appears in the model parameters json file.
+    :param suffix: Suffix of the weights file (see get_weights_path).
+    :param quantize: Boolean, whether to apply dynamic quantization.
+    :param num_threads: Number of torch CPU threads used while exporting, or None to keep the torch default.
+    :return: The path of the exported model.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model, params = get_model(model_name)
+    model.load_state_dict(torch.load(get_weights_path(model_name, suffix), map_location="cpu"))
+    model = model.cpu().float().eval()
+    model.device = torch.device("cpu")
+
+    if quantize:
+        model = torch.quantization.quantize_dynamic(
+            model, {nn.GRU, nn.LSTM, nn.GRUCell, nn.LSTMCell, nn.Linear}, dtype=torch.qint8
+        )
+
+    example = torch.zeros((1, params["network_params"]["inp_seq_len"], 4))
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    path = get_exported_path(model_name, suffix)
+    torch.jit.save(traced, path)
+    return path
+
+
+def export_all_models(suffix="best", quantize=False, num_threads=None):
+    """
+    Export every model in the model parameters json file that has a weights file. See export_model.
+
+    :return: A list of the exported model paths.
+    """
+    paths = []
+    for model_name in get_models_dict().keys():
+        if not os.path.exists(get_weights_path(model_name, suffix)):
+            continue
+        try:
+            paths.append(export_model(model_name, suffix, quantize=quantize, num_threads=num_threads))
+        except Exception as e:
+            print(f"Unable to export model {model_name}: {e}")
+    return paths
+
+
 def update_models_json(model_name, model_dict):
     """
     Add a new model to the model parameters json file.
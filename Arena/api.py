@@ -8,8 +8,9 @@ from pathlib import Path
 from utils import titlize, turn_display_on, turn_display_off
 from cache import RedisCache, CacheColumns
 from mqtt import MQTTPublisher
+from frames import Frame
 from experiment import Experiment, ExperimentCache
-from arena import SpinCamera, record, capture_image, filter_cameras, display_info
+from arena import SpinCamera, record, capture_image, filter_cameras, display_info, camera_manager
 
 app = Flask(__name__)
 cache = RedisCache()
@@ -195,6 +196,18 @@ def send_media(filename):
 
 class VideoStream:
     def __init__(self, exposure_time=config.exposure_time):
+        self.session = None
+        self.cam_list = None
+        if config.is_persistent_cameras:
+            # only the streamed camera is reserved, so recordings can use the other cameras
+            self.session = camera_manager.session(cache.get(CacheColumns.STREAM_CAMERA), max_cameras=1)
+            if len(self.session.cameras) == 0:
+                self.session.close()
+                raise Exception('No cameras were found')
+            self.sc = self.session.cameras[0]
+            self.sc.begin_acquisition(exposure_time)
+            return
+
         self.system = PySpin.System.GetInstance()
         self.cam_list = self.system.GetCameras()
         filter_cameras(self.cam_list, cache.get(CacheColumns.STREAM_CAMERA))
@@ -207,12 +220,21 @@ class VideoStream:
 
     def get_frame(self):
         image_result = self.sc.cam.GetNextImage()
-        img = image_result.GetNDArray()
-        return cv2.imencode(".jpg", img)
+        frame = Frame(image_result.GetNDArray(), config.camera_channel_order)
+        encoded = cv2.imencode(".jpg", frame.to('BGR'))
+        image_result.Release()
+        return encoded
 
     def clear(self):
+        if self.session is not None:
+            self.session.close()  # the camera stays open in the camera manager
+            return
+        if self.cam_list is None:
+            return  # the cameras were never acquired
         self.cam_list.Clear()
-        del self.sc
+        self.cam_list = None
+        if hasattr(self, 'sc'):
+            del self.sc
         # self.system.ReleaseInstance()
 
     def __del__(self):
@@ -5,15 +5,21 @@ import re
 import cv2
 import json
 import argparse
+import threading
+import queue
+import multiprocessing
+import subprocess
 
 import pandas as pd
 import numpy as np
 from multiprocessing.dummy import Pool
 import PySpin
 import config
-from cache import CacheColumns
+from cache import CacheColumns, RedisCache
+from frames import Frame
+from metrics import AcquisitionMetrics
 from mqtt import MQTTPublisher
-from utils import get_logger, calculate_fps, mkdir, get_log_stream, datetime_string
+from utils import get_logger, fps_from_diffs, mkdir, get_log_stream, datetime_string
 
 ################################################ Predictor ################################################
 
@@ -30,45 +36,65 @@ if not config.is_disable_predictor:
 
 class SpinCamera:
     def __init__(self, cam: PySpin.Camera, acquire_stop=None, dir_path=None, cache=None, log_stream=None,
-                 is_use_predictions=False):
+                 is_use_predictions=False, stop_monitor=None):
         self.cam = cam
+        self.mqtt_client = None
+        self.configured_exposure = None  # exposure of the last configuration, None if not configured
+
+        self.cam.Init()
+        self.name = self.get_camera_name()
+        self.start_session(acquire_stop, dir_path, cache, log_stream, is_use_predictions, stop_monitor)
+
+    def start_session(self, acquire_stop=None, dir_path=None, cache=None, log_stream=None,
+                      is_use_predictions=False, stop_monitor=None):
+        """Reset the per-trial state of the camera. The camera itself stays initialised between sessions"""
         self.acquire_stop = acquire_stop or {'num_frames': config.default_num_frames}
         self.dir_path = dir_path
         self.cache = cache
         self.is_use_predictions = is_use_predictions
         self.thread_event = None
+        self.stop_monitor = stop_monitor
+        self.is_own_stop_monitor = False
         self.validate_acquire_stop()
 
         self.is_ready = False  # ready for acquisition
         self.video_out = None
         self.start_acquire_time = None
-        self.mqtt_client = None
+        self.predictor_worker = None
 
-        self.cam.Init()
         self.logger = get_logger(self.device_id, dir_path, log_stream=log_stream)
-        self.name = self.get_camera_name()
+        self.metrics = AcquisitionMetrics(self.name or self.device_id)
         if self.is_realtime_mode:
             self.logger.info('Working in realtime mode')
             self.predictor_experiment_ids = []
             self.predictor = predictor.gen_hit_predictor(self.logger, dir_path)
-            self.mqtt_client = MQTTPublisher()
+            if self.mqtt_client is None:
+                self.mqtt_client = MQTTPublisher()
 
     def begin_acquisition(self, exposure):
         """Main function for running camera acquisition in trigger mode"""
         try:
-            self.configure_camera(exposure)
+            if self.configured_exposure != exposure:
+                self.configure_camera(exposure)
             self.cam.BeginAcquisition()
             self.is_ready = True
             self.logger.debug('Entering to trigger mode')
         except Exception as exc:
             self.logger.error(f'(run); {exc}')
 
-    def __del__(self):
+    def close(self):
+        """End acquisition and de-initialise the camera. The SpinCamera can't be used after it is closed"""
+        if getattr(self, 'cam', None) is None:
+            return
         if self.is_realtime_mode:
             self.predictor.reset()
         if self.cam.IsStreaming():
             self.cam.EndAcquisition()
         self.cam.DeInit()
+        self.cam = None  # drop the camera pointer, so the PySpin system can be released
+
+    def __del__(self):
+        self.close()
 
     def configure_camera(self, exposure):
         """Configure camera for trigger mode before acquisition"""
@@ -83,21 +109,31 @@ class SpinCamera:
             self.cam.TriggerActivation.SetValue(PySpin.TriggerActivation_RisingEdge)
             self.cam.DeviceLinkThroughputLimit.SetValue(self.get_max_throughput())
             self.cam.ExposureTime.SetValue(exposure)
+            self.configured_exposure = exposure
             self.logger.info(f'Finished Configuration')
             self.log_info()
 
         except PySpin.SpinnakerException as exc:
             self.logger.error(f'(configure_images); {exc}')
 
-    def acquire(self):
-        """Acquire images and measure FPS"""
+    def acquire(self) -> dict:
+        """Acquire images and measure FPS. Return a summary of the acquisition"""
+        summary = {}
         if self.is_ready:
-            frame_times = list()
+            timestamps = TimestampRecorder(self.cam, self.timestamp_path, self.clock_path)
             image_handler_times = list()
+            frame_buffer, writer = self.start_frame_writer()
+            self.start_predictor_worker()
+            self.metrics.start()
             i = 0
-            while self.is_acquire_allowed(i):
+            while True:
+                with self.metrics.measure('stop_checks'):
+                    is_allowed = self.is_acquire_allowed(i)
+                if not is_allowed:
+                    break
                 try:
-                    image_result = self.cam.GetNextImage(2000)  # Retrieve next received image
+                    with self.metrics.measure('grab_wait'):
+                        image_result = self.cam.GetNextImage(2000)  # Retrieve next received image
                     if i == 0:
                         self.start_acquire_time = time.time()
                         self.logger.info('Acquisition Started')
@@ -110,13 +146,23 @@ class SpinCamera:
                             image_result.Release()
                             break
                     else:
-                        frame_times.append(image_result.GetTimeStamp())
                         t0 = time.time()
-                        self.image_handler(image_result, i)
+                        img = image_result.GetNDArray()
+                        if frame_buffer is not None:
+                            is_frame_saved = frame_buffer.put(img, i)
+                        else:
+                            self.image_handler(img, i)
+                            is_frame_saved = True
                         image_handler_times.append(time.time() - t0)
+                        if is_frame_saved:
+                            timestamps.add(image_result.GetTimeStamp())
 
                     image_result.Release()  # Release image
 
+                    if frame_buffer is not None and i % config.frame_buffer_log_interval == 0:
+                        self.logger.debug(f'Frame buffer depth: {frame_buffer.depth}/{frame_buffer.size}, '
+                                          f'dropped frames: {frame_buffer.num_dropped}')
+
                 except PySpin.SpinnakerException as exc:
                     self.logger.error(f'(acquire); {exc}')
                     continue
@@ -125,35 +171,90 @@ class SpinCamera:
                     i += 1
 
             self.logger.info(f'Number of frames taken: {i}')
-            mean_fps, std_fps = self.analyze_timestamps(frame_times)
+            if writer is not None:
+                self.stop_frame_writer(frame_buffer, writer)
+            if self.predictor_worker is not None:
+                self.stop_predictor_worker()
+            mean_fps, std_fps = self.analyze_timestamps(timestamps)
             self.logger.debug(f'Calculated FPS: {mean_fps:.3f} ± {std_fps:.3f}')
             self.logger.debug(f'Average image handler time: {np.mean(image_handler_times):.4f} seconds')
+            self.logger.debug(f'Stage timings:\n{self.metrics.summary()}')
             if self.is_realtime_mode:
                 self.predictor.save_predictions()
+            summary = {'num_frames': i, 'mean_fps': mean_fps, 'std_fps': std_fps}
 
         self.cam.EndAcquisition()  # End acquisition
         if self.video_out:
-            self.logger.info(f'Video path: {self.video_path}')
+            self.logger.info(f'Video path: {self.video_out.path}')
             self.video_out.release()
+        if self.is_own_stop_monitor:
+            self.stop_monitor.stop()
+        self.metrics.stop()
         self.is_ready = False
+        return summary
 
-    def image_handler(self, image_result: PySpin.ImagePtr, i: int):
-        img = image_result.GetNDArray()
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def image_handler(self, img: np.ndarray, i: int):
+        frame = Frame(img, config.camera_channel_order, i)
 
         if self.is_realtime_mode:
-            self.handle_prediction(img, i)
+            if config.is_predictor_experiment and not i % 60:
+                self.predictor_experiment_ids.append(i)
+                self.mqtt_client.publish_command('show_pogona', 3)
+            if self.predictor_worker is not None:
+                # the worker copies the frame, as the camera buffer is released after this handler
+                self.predictor_worker.submit(frame)
+            else:
+                with self.metrics.measure('predictor'):
+                    self.handle_prediction(frame, i)
 
         if not self.is_realtime_mode or config.is_predictor_experiment:
             if self.dir_path and self.video_out is None:
-                fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-                h, w = img.shape[:2]
-                self.video_out = cv2.VideoWriter(self.video_path, fourcc, config.fps, (w, h), True)
+                h, w = frame.shape[:2]
+                self.video_out = VIDEO_SINKS[config.video_sink](self.video_path, config.fps, (w, h), logger=self.logger)
 
-            self.video_out.write(img)
+            with self.metrics.measure('color_conversion'):
+                frame.to(self.video_out.channel_order)  # cached in the frame for the sink
+            with self.metrics.measure('video_write'):
+                self.video_out.write(frame)
 
         # img.Convert(PySpin.PixelFormat_Mono8, PySpin.HQ_LINEAR)
 
+    def start_frame_writer(self):
+        """Start the writer thread in async mode. Frames are then handled outside of the grab loop"""
+        if not config.is_async_video_writer:
+            return None, None
+        frame_buffer = FrameRingBuffer(config.frame_buffer_size)
+        writer = FrameWriter(self, frame_buffer)
+        writer.start()
+        self.logger.debug(f'Async frame writer started with buffer size {frame_buffer.size}')
+        return frame_buffer, writer
+
+    def stop_frame_writer(self, frame_buffer, writer):
+        """Wait for the writer thread to drain the frame buffer"""
+        frame_buffer.close()
+        writer.join()
+        self.logger.info(f'Frame buffer max depth: {frame_buffer.max_depth}/{frame_buffer.size}, '
+                         f'dropped frames: {frame_buffer.num_dropped}')
+
+    def start_predictor_worker(self):
+        """Run the realtime predictor on its own thread, so a slow prediction doesn't hold the grab loop"""
+        if not self.is_realtime_mode or not config.is_async_predictor:
+            return
+        self.predictor_worker = PredictorWorker(self)
+        self.predictor_worker.start()
+        self.logger.debug('Predictor worker started')
+
+    def stop_predictor_worker(self):
+        """Wait for the last prediction, and save the frame index and latency of every prediction"""
+        worker = self.predictor_worker
+        worker.close()
+        worker.join()
+        if self.dir_path:
+            worker.save(self.prediction_latency_path)
+        self.logger.info(f'Predictions: {len(worker.records)}, skipped frames: {worker.num_dropped}, '
+                         f'mean latency: {worker.mean_latency():.4f} seconds')
+        self.predictor_worker = None
+
     def validate_acquire_stop(self):
         for key, value in self.acquire_stop.items():
             assert key in config.acquire_stop_options, f'unknown acquire_stop: {key}'
@@ -165,6 +266,12 @@ class SpinCamera:
             else:
                 assert isinstance(value, int), f'acquire stop {key}: expected type int, received {type(value)}'
 
+        is_cache_stop = any(config.acquire_stop_options[key] == 'cache' for key in self.acquire_stop)
+        if is_cache_stop and self.stop_monitor is None:
+            self.stop_monitor = AcquireStopMonitor(self.cache)
+            self.stop_monitor.start()
+            self.is_own_stop_monitor = True
+
     def is_acquire_allowed(self, iteration):
         """Check all given acquire_stop conditions"""
         for stop_key in self.acquire_stop.keys():
@@ -181,10 +288,10 @@ class SpinCamera:
         return time.time() < self.start_acquire_time + self.acquire_stop['record_time']
 
     def check_manual_stop(self, iteration):
-        return not self.cache.get(CacheColumns.MANUAL_RECORD_STOP)
+        return not self.stop_monitor.is_manual_stop
 
     def check_trial_alive(self, iteration):
-        return self.cache.get(CacheColumns.EXPERIMENT_TRIAL_ON)
+        return self.stop_monitor.is_trial_alive
 
     def check_thread_event(self, iteration):
         return self.thread_event.is_set()
@@ -194,8 +301,7 @@ class SpinCamera:
         self.begin_acquisition(exposure)
         try:
             image_result = self.cam.GetNextImage()
-            img = image_result.GetNDArray()
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            img = Frame(image_result.GetNDArray(), config.camera_channel_order).to('BGR')
             image_result.Release()
             return img
         except PySpin.SpinnakerException as exc:
@@ -203,16 +309,14 @@ class SpinCamera:
         finally:
             self.cam.EndAcquisition()
 
-    def handle_prediction(self, img, i):
-        if config.is_predictor_experiment and not i % 60:
-            self.predictor_experiment_ids.append(i)
-            self.mqtt_client.publish_command('show_pogona', 3)
-        forecast, hit_point, hit_steps = self.predictor.handle_frame(img)
+    def handle_prediction(self, frame: Frame, i):
+        forecast, hit_point, hit_steps = self.predictor.handle_frame(frame)
         if hit_point is None or not hit_steps:
             return
 
         time2hit = (1 / config.fps) * hit_steps  # seconds
-        self.mqtt_client.publish_event('event/log/prediction', json.dumps({'hit_point': hit_point.tolist(), 'time2hit': time2hit}))
+        self.mqtt_client.publish_event('event/log/prediction', json.dumps({'hit_point': hit_point.tolist(),
+                                                                           'time2hit': time2hit, 'frame_id': i}))
 
     def log_info(self):
         """Print into logger the info of the camera"""
@@ -221,17 +325,11 @@ class SpinCamera:
             st += f'{k}: {v}\n'
         self.logger.debug(st)
 
-    def analyze_timestamps(self, frame_times):
-        """Convert camera's timestamp to server time, save server timestamps and calculate FPS"""
-        self.cam.TimestampLatch()
-        camera_time = self.cam.TimestampLatchValue.GetValue()
-        server_time = time.time()
-        frame_times = server_time - (camera_time - pd.Series(frame_times)) / 1e9
-        mean_fps, std_fps = calculate_fps(frame_times)
-
-        frame_times = pd.to_datetime(frame_times, unit='s')
-        frame_times.to_csv(self.timestamp_path)
+    def analyze_timestamps(self, timestamps):
+        """Write the remaining server timestamps, save predictor times and calculate FPS"""
+        mean_fps, std_fps = timestamps.close()
         if config.is_predictor_experiment and self.is_realtime_mode:
+            frame_times = pd.read_csv(self.timestamp_path, index_col=0, parse_dates=['0'])['0']
             predictor_times = frame_times[self.predictor_experiment_ids]
             predictor_times.to_csv(f'{self.dir_path}/predictor_times.csv')
 
@@ -281,13 +379,22 @@ class SpinCamera:
 
     @property
     def video_path(self):
-        return f'{self.dir_path}/{self.name}_{datetime_string()}.avi'
+        return f'{self.dir_path}/{self.name}_{datetime_string()}.{VIDEO_SINKS[config.video_sink].suffix}'
 
     @property
     def timestamp_path(self):
         mkdir(f'{self.dir_path}/timestamps')
         return f'{self.dir_path}/timestamps/{self.device_id}.csv'
 
+    @property
+    def clock_path(self):
+        mkdir(f'{self.dir_path}/timestamps')
+        return f'{self.dir_path}/timestamps/{self.device_id}_clock.json'
+
+    @property
+    def prediction_latency_path(self):
+        return f'{self.dir_path}/prediction_latency.csv'
+
     @property
     def device_id(self):
         return get_device_id(self.cam)
@@ -297,6 +404,527 @@ class SpinCamera:
         return IS_PREDICTOR_READY and self.is_use_predictions and self.name == config.realtime_camera
 
 
+class AcquireStopMonitor(threading.Thread):
+    """
+    Thread that polls the cache-based acquire_stop conditions (manual_stop, trial_alive) at a fixed rate.
+    The grab loops read the in-process flags, instead of a Redis round-trip on every frame of every camera.
+    A single monitor can be shared by all the cameras of a recording.
+    """
+    def __init__(self, cache, interval=config.acquire_stop_poll_interval):
+        super().__init__(name='acquire-stop-monitor', daemon=True)
+        self.cache = cache
+        self.interval = interval
+        self.is_manual_stop = False
+        self.is_trial_alive = True
+        self.done = threading.Event()
+        self.poll()  # flags are valid before the first frame
+
+    def poll(self):
+        self.is_manual_stop = bool(self.cache.get(CacheColumns.MANUAL_RECORD_STOP))
+        self.is_trial_alive = bool(self.cache.get(CacheColumns.EXPERIMENT_TRIAL_ON))
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as exc:
+                print(f'Error in acquire stop monitor: {exc}')
+
+    def stop(self):
+        self.done.set()
+
+
+class CameraClock:
+    """
+    Linear model of the server time as a function of the camera clock:
+        server_time = offset + drift * (camera_time - camera_ref) / 1e9
+    The model is fitted to (camera time, server time) pairs, sampled with TimestampLatch periodically during
+    acquisition, so the camera clock drift over long recordings is accounted for.
+    """
+    def __init__(self, cam):
+        self.cam = cam
+        self.samples = []  # (camera time [ns], server time [s])
+        self.camera_ref = None
+        self.offset = None
+        self.drift = 1.0
+
+    def sample(self):
+        """Latch the camera clock, pair it with the server time and refit the model"""
+        self.cam.TimestampLatch()
+        camera_time = self.cam.TimestampLatchValue.GetValue()
+        server_time = time.time()
+        self.samples.append((int(camera_time), server_time))
+        self.fit()
+
+    def fit(self):
+        camera_times = np.array([c for c, _ in self.samples], dtype=np.int64)
+        server_times = np.array([s for _, s in self.samples])
+        self.camera_ref = int(camera_times[0])
+        x = (camera_times - self.camera_ref) / 1e9
+        y = server_times - server_times[0]
+        if len(self.samples) < 2:
+            drift, intercept = 1.0, y[-1] - x[-1]
+        else:
+            drift, intercept = np.polyfit(x, y, 1)
+        self.drift = float(drift)
+        self.offset = float(server_times[0] + intercept)
+
+    def to_server_time(self, camera_times: np.ndarray) -> np.ndarray:
+        """Convert camera timestamps (ns) to server time (seconds since epoch)"""
+        return self.offset + self.drift * (camera_times - self.camera_ref) / 1e9
+
+    def save(self, path):
+        camera_times = np.array([c for c, _ in self.samples], dtype=np.int64)
+        server_times = np.array([s for _, s in self.samples])
+        residuals = server_times - self.to_server_time(camera_times)
+        with open(path, 'w') as f:
+            json.dump({
+                'camera_ref': self.camera_ref,
+                'offset': self.offset,
+                'drift': self.drift,
+                'residual_std': float(np.std(residuals)),
+                'samples': [[c, s] for c, s in self.samples]
+            }, f, indent=2)
+
+
+class TimestampRecorder:
+    """
+    Write the frame timestamps of a camera to its timestamps csv in chunks, during acquisition.
+    The camera clock is sampled on every chunk and each chunk is converted to server time with the clock model
+    fitted so far, so a crash loses at most one chunk, and the frame times are never held in memory for the whole
+    recording. The raw camera timestamps are kept in the csv, so the frames can be re-projected later with the
+    final clock model that is saved next to the timestamps. FPS statistics of the frame time differences are
+    merged chunk by chunk.
+    """
+    def __init__(self, cam, path, clock_path, chunk_size=config.timestamps_chunk_size):
+        self.path = path
+        self.clock_path = clock_path
+        self.clock = CameraClock(cam)
+        self.clock.sample()
+        self.chunk = np.empty(chunk_size, dtype=np.int64)
+        self.chunk_len = 0
+        self.num_frames = 0  # frames written to file
+        self.last_time = None  # server time of the last written frame
+        # running statistics of the time differences between frames
+        self.num_diffs = 0
+        self.mean_diff = 0.0
+        self.m2_diff = 0.0
+        # the header is written right away, so the file exists even if no frame is acquired
+        pd.DataFrame(columns=['0', 'camera_timestamp']).to_csv(self.path)
+
+    def add(self, camera_timestamp: int):
+        """Add the camera timestamp (ns) of a frame. The chunk is written once it is full"""
+        self.chunk[self.chunk_len] = camera_timestamp
+        self.chunk_len += 1
+        if self.chunk_len == len(self.chunk):
+            self.flush()
+
+    def flush(self):
+        """Convert the current chunk and append it to the timestamps file"""
+        if self.chunk_len == 0:
+            return
+        self.clock.sample()
+        camera_times = self.chunk[:self.chunk_len]
+        frame_times = self.clock.to_server_time(camera_times)
+        self.update_statistics(frame_times)
+
+        index = np.arange(self.num_frames, self.num_frames + self.chunk_len)
+        df = pd.DataFrame({'0': pd.to_datetime(frame_times, unit='s'), 'camera_timestamp': camera_times}, index=index)
+        df.to_csv(self.path, mode='a', header=False)
+        self.num_frames += self.chunk_len
+        self.chunk_len = 0
+
+    def update_statistics(self, frame_times: np.ndarray):
+        """Merge the time differences of a chunk into the running mean and variance"""
+        if self.last_time is not None:
+            frame_times = np.concatenate([[self.last_time], frame_times])
+        self.last_time = frame_times[-1]
+        diffs = np.diff(frame_times)
+        if len(diffs) == 0:
+            return
+        n, mean, m2 = len(diffs), diffs.mean(), ((diffs - diffs.mean()) ** 2).sum()
+        total = self.num_diffs + n
+        delta = mean - self.mean_diff
+        self.mean_diff += delta * n / total
+        self.m2_diff += m2 + delta ** 2 * self.num_diffs * n / total
+        self.num_diffs = total
+
+    def close(self):
+        """Write the last chunk, save the clock model and return the FPS mean and std"""
+        self.flush()
+        self.clock.save(self.clock_path)
+        if self.num_diffs == 0:
+            return np.nan, np.nan
+        return fps_from_diffs(self.mean_diff, np.sqrt(self.m2_diff / self.num_diffs), self.num_diffs)
+
+
+class VideoSink:
+    """
+    Abstract class for the video output of a camera. Subclasses receive Frame objects during acquisition
+    and write them in the channel order they need, so a frame is converted only if the sink requires it.
+    """
+    channel_order = 'BGR'
+    suffix = 'avi'
+
+    def __init__(self, path, fps, size, logger=None):
+        """
+        :param path: path of the output video file
+        :param fps: frame rate of the output video
+        :param size: (width, height) of the frames
+        :param logger: logger of the camera, for reporting sink errors
+        """
+        self.path = path
+        self.fps = fps
+        self.size = size
+        self.logger = logger
+
+    def write(self, frame: Frame):
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+
+class OpenCVSink(VideoSink):
+    """MJPG avi file written by cv2.VideoWriter"""
+    def __init__(self, path, fps, size, logger=None):
+        super().__init__(path, fps, size, logger)
+        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+        self.writer = cv2.VideoWriter(path, fourcc, fps, size, True)
+
+    def write(self, frame: Frame):
+        self.writer.write(frame.to(self.channel_order))
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegSink(VideoSink):
+    """
+    Compressed video file, encoded by an ffmpeg subprocess that reads raw frames from a pipe.
+    Codec, preset and quality are taken from config, and any ffmpeg encoder can be used (e.g. libx264, libx265,
+    h264_nvenc). The quality is passed as -crf for the software encoders and as a constant quality (-cq) for nvenc.
+    Raw frames are piped in the camera channel order, so no color conversion is done in Python.
+
+    If ffmpeg can't be started or exits during the acquisition (e.g. bad codec options), the error is logged and
+    the next frames are discarded, so the acquisition itself isn't interrupted.
+    """
+    channel_order = 'RGB'
+    suffix = 'mp4'
+
+    def __init__(self, path, fps, size, logger=None, codec=config.video_codec, preset=config.video_preset,
+                 crf=config.video_crf):
+        super().__init__(path, fps, size, logger)
+        w, h = size
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', str(fps), '-i', '-',
+               '-c:v', codec, '-preset', preset] + self.quality_args(codec, crf) + ['-pix_fmt', 'yuv420p']
+        if codec == 'libx265':
+            cmd += ['-tag:v', 'hvc1']
+        try:
+            self.process = subprocess.Popen(cmd + [path], stdin=subprocess.PIPE)
+        except OSError as exc:
+            self.process = None
+            self.log_error(f'Unable to start ffmpeg: {exc}')
+
+    @staticmethod
+    def quality_args(codec, crf):
+        if codec.endswith('_nvenc'):
+            return ['-rc', 'vbr', '-cq', str(crf)]
+        return ['-crf', str(crf)]
+
+    def log_error(self, msg):
+        if self.logger is not None:
+            self.logger.error(msg)
+        else:
+            print(msg)
+
+    def write(self, frame: Frame):
+        if self.process is None:
+            return
+        img = np.ascontiguousarray(frame.to(self.channel_order))
+        try:
+            self.process.stdin.write(img.data)
+        except OSError as exc:
+            self.log_error(f'ffmpeg stopped with exit code {self.process.poll()}, '
+                           f'discarding the next frames: {exc}')
+            self.release()
+
+    def release(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
+
+VIDEO_SINKS = {
+    'opencv': OpenCVSink,
+    'ffmpeg': FFmpegSink
+}
+
+
+class FrameRingBuffer:
+    """
+    Bounded ring of preallocated frame buffers, shared between the grab loop of a camera (producer) and
+    its writer thread (consumer). Frames are copied into the ring, so the PySpin image can be released right away.
+    When the ring is full the new frame is dropped and counted.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.frames = None  # allocated on first frame, when the frame shape is known
+        self.frame_ids = np.zeros(size, dtype=np.int64)
+        self.head = 0  # slot of the oldest frame
+        self.depth = 0  # number of frames waiting in the ring
+        self.max_depth = 0
+        self.num_dropped = 0
+        self.is_closed = False
+        self.cond = threading.Condition()
+
+    def put(self, img: np.ndarray, frame_id: int) -> bool:
+        """Copy image into the next free slot. Return False if the ring is full and the frame was dropped"""
+        with self.cond:
+            if self.depth == self.size:
+                self.num_dropped += 1
+                return False
+            slot = (self.head + self.depth) % self.size
+
+        if self.frames is None:
+            self.frames = np.empty((self.size, *img.shape), dtype=img.dtype)
+        # the slot is not visible to the consumer until depth is incremented, so copy without holding the lock
+        np.copyto(self.frames[slot], img)
+
+        with self.cond:
+            self.frame_ids[slot] = frame_id
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.cond.notify()
+        return True
+
+    def get(self):
+        """Wait for the oldest frame and return (frame, frame_id), or None if the ring is closed and empty.
+        The returned frame is a view on the ring and is valid until release() is called."""
+        with self.cond:
+            while self.depth == 0:
+                if self.is_closed:
+                    return None
+                self.cond.wait()
+            return self.frames[self.head], int(self.frame_ids[self.head])
+
+    def release(self):
+        """Free the slot of the oldest frame"""
+        with self.cond:
+            self.head = (self.head + 1) % self.size
+            self.depth -= 1
+
+    def close(self):
+        """No more frames will be added. The consumer drains the remaining frames and stops"""
+        with self.cond:
+            self.is_closed = True
+            self.cond.notify_all()
+
+
+class FrameWriter(threading.Thread):
+    """Thread that drains the frame ring buffer of a camera into its image handler"""
+    def __init__(self, sc: SpinCamera, frame_buffer: FrameRingBuffer):
+        super().__init__(name=f'writer-{sc.device_id}', daemon=True)
+        self.sc = sc
+        self.frame_buffer = frame_buffer
+
+    def run(self):
+        while True:
+            item = self.frame_buffer.get()
+            if item is None:
+                break
+            img, frame_id = item
+            try:
+                self.sc.image_handler(img, frame_id)
+            except Exception as exc:
+                self.sc.logger.error(f'(frame writer); {exc}')
+            finally:
+                self.frame_buffer.release()
+
+
+class PredictorWorker(threading.Thread):
+    """
+    Thread that runs the realtime predictor of a camera on the newest frame only. A frame that arrives while
+    a prediction is running replaces the pending frame, so stale frames are dropped instead of queued.
+
+    Submitted frames are copied into one of two preallocated buffers: one holds the frame that is being predicted,
+    and the other the pending frame, which is overwritten in place by newer frames.
+    """
+    def __init__(self, sc: SpinCamera):
+        super().__init__(name=f'predictor-{sc.device_id}', daemon=True)
+        self.sc = sc
+        self.buffers = [None, None]  # allocated on first frame, when the frame shape is known
+        self.pending = None  # (frame, buffer slot, submit time)
+        self.busy_slot = None  # buffer of the frame that is being predicted
+        self.last_frame_id = -1
+        self.num_dropped = 0
+        self.records = []  # (frame_id, submit_time, start_time, end_time) of every prediction
+        self.is_closed = False
+        self.cond = threading.Condition()
+
+    def submit(self, frame: Frame):
+        """Copy the frame into the free buffer and make it the pending frame"""
+        with self.cond:
+            if self.pending is not None:
+                self.num_dropped += 1
+            slot = 0 if self.busy_slot == 1 else 1
+            buffer = self.buffers[slot]
+            if buffer is None or buffer.shape != frame.data.shape or buffer.dtype != frame.data.dtype:
+                buffer = self.buffers[slot] = np.empty_like(frame.data)
+            np.copyto(buffer, frame.data)
+            self.pending = (Frame(buffer, frame.channel_order, frame.frame_id), slot, time.time())
+            self.cond.notify()
+
+    def close(self):
+        """No more frames will be submitted. The pending frame is still predicted"""
+        with self.cond:
+            self.is_closed = True
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.is_closed:
+                    self.cond.wait()
+                if self.pending is None:
+                    break
+                (frame, self.busy_slot, submit_time), self.pending = self.pending, None
+
+            start_time = time.time()
+            try:
+                # keep one history row per camera frame, also for the dropped frames
+                self.sc.predictor.skip_frames(frame.frame_id - self.last_frame_id - 1)
+                self.sc.handle_prediction(frame, frame.frame_id)
+            except Exception as exc:
+                self.sc.logger.error(f'(predictor worker); {exc}')
+            finally:
+                end_time = time.time()
+                self.sc.metrics.add('predictor', end_time - start_time)
+                self.last_frame_id = frame.frame_id
+                self.records.append((frame.frame_id, submit_time, start_time, end_time))
+                with self.cond:
+                    self.busy_slot = None
+
+    def mean_latency(self) -> float:
+        """Mean time from frame submission to the end of its prediction, in seconds"""
+        if not self.records:
+            return np.nan
+        return float(np.mean([end - submit for _, submit, _, end in self.records]))
+
+    def save(self, path):
+        pd.DataFrame(self.records, columns=['frame_id', 'submit_time', 'start_time', 'end_time']).to_csv(path, index=False)
+
+
+class CameraSession:
+    """Cameras handed out by the CameraManager. The cameras return to the manager when the session is closed"""
+    def __init__(self, manager, cameras: list):
+        self.manager = manager
+        self.cameras = cameras
+        self.is_closed = False
+
+    def close(self):
+        if not self.is_closed:
+            self.manager.release(self.cameras)
+            self.is_closed = True
+
+    def __enter__(self):
+        return self.cameras
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CameraManager:
+    """
+    Long-lived owner of the PySpin cameras. Cameras are initialised once and stay configured across trials,
+    while recordings, streams and captures get sessions of the cameras they need. A camera can be used by a
+    single session at a time.
+    """
+    def __init__(self):
+        self.system = None
+        self.cameras = {}  # device_id: SpinCamera
+        self.busy = set()
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Initialise the connected cameras that are not open yet"""
+        with self.lock:
+            if self.system is None:
+                self.system = PySpin.System.GetInstance()
+            cam_list = self.system.GetCameras()
+            for cam in cam_list:
+                device_id = get_device_id(cam)
+                if device_id not in self.cameras:
+                    self.cameras[device_id] = SpinCamera(cam)
+            cam_list.Clear()
+
+    def get_cameras(self, cameras_string=None) -> list:
+        """Get the open cameras that match cameras_string. Look for new cameras if none matches"""
+        for is_retry in [False, True]:
+            if is_retry or not self.cameras:
+                self.open()
+            device_ids = list(self.cameras.keys())
+            if cameras_string:
+                device_ids = select_devices(device_ids, cameras_string)
+            if device_ids:
+                break
+        return [self.cameras[device_id] for device_id in device_ids]
+
+    def session(self, cameras_string=None, max_cameras=None) -> CameraSession:
+        """
+        Reserve the open cameras that match cameras_string for a new session.
+        :param cameras_string: cameras to reserve (see select_devices), all cameras if None
+        :param max_cameras: reserve at most this number of the matching cameras
+        """
+        cameras = self.get_cameras(cameras_string)
+        if max_cameras is not None:
+            cameras = cameras[:max_cameras]
+        with self.lock:
+            busy = [sc.device_id for sc in cameras if sc.device_id in self.busy]
+            if busy:
+                raise Exception(f'Cameras are used by another session: {busy}')
+            self.busy.update(sc.device_id for sc in cameras)
+        return CameraSession(self, cameras)
+
+    def release(self, cameras: list):
+        for sc in cameras:
+            try:
+                if sc.cam.IsStreaming():
+                    sc.cam.EndAcquisition()
+            except PySpin.SpinnakerException as exc:
+                sc.logger.error(f'(release); {exc}')
+        with self.lock:
+            self.busy.difference_update(sc.device_id for sc in cameras)
+
+    def close(self):
+        """
+        De-initialise all cameras and release the PySpin system, for example before camera processes open
+        the cameras by themselves. Raise an exception if cameras are still used by a session (e.g. a video stream).
+        """
+        with self.lock:
+            if self.busy:
+                raise Exception(f'Unable to close cameras {sorted(self.busy)}, they are used by another session '
+                                f'(e.g. a video stream). Stop it and try again')
+            for sc in self.cameras.values():
+                try:
+                    sc.close()
+                except PySpin.SpinnakerException as exc:
+                    sc.logger.error(f'(close); {exc}')
+            self.cameras.clear()
+            if self.system is not None:
+                self.system.ReleaseInstance()
+                self.system = None
+
+
+camera_manager = CameraManager()
+
+
 ############################################################################################################
 
 
@@ -310,9 +938,8 @@ def get_device_id(cam) -> str:
     return m[0]
 
 
-def filter_cameras(cam_list: PySpin.CameraList, cameras_string: str) -> None:
-    """Filter cameras according to camera_label, which can be a name or last digits of device ID"""
-    current_devices = [get_device_id(cam) for cam in cam_list]
+def select_devices(current_devices: list, cameras_string: str) -> list:
+    """Select device IDs according to cameras_string, which can be names or last digits of device IDs"""
     chosen_devices = []
     for cam_id in cameras_string.split(','):
         if re.match(r'[a-zA-z]+', cam_id):
@@ -321,6 +948,13 @@ def filter_cameras(cam_list: PySpin.CameraList, cameras_string: str) -> None:
                 chosen_devices.append(device)
         elif re.match(r'[0-9]+', cam_id):
             chosen_devices.extend([d for d in current_devices if d[-len(cam_id):] == cam_id])
+    return chosen_devices
+
+
+def filter_cameras(cam_list: PySpin.CameraList, cameras_string: str) -> None:
+    """Filter cameras according to camera_label, which can be a name or last digits of device ID"""
+    current_devices = [get_device_id(cam) for cam in cam_list]
+    chosen_devices = select_devices(current_devices, cameras_string)
 
     def _remove_from_cam_list(device_id):
         devices = [get_device_id(c) for c in cam_list]
@@ -335,6 +969,13 @@ def display_info():
     """Function for displaying info of all FireFly cameras detected"""
     df = []
     index = []
+    if config.is_persistent_cameras:
+        for sc in camera_manager.get_cameras():
+            if sc.is_firefly():
+                df.append(sc.info())
+                index.append(sc.device_id)
+        return f'\nCameras Info:\n\n{pd.DataFrame(df, columns=config.info_fields, index=index).to_string()}\n'
+
     system = PySpin.System.GetInstance()
     cam_list = system.GetCameras()
     for cam in cam_list:
@@ -352,9 +993,19 @@ def display_info():
     return output
 
 
-def start_camera(cam, acquire_stop, dir_path, exposure, cache, log_stream, is_use_predictions):
+def start_camera(cam, acquire_stop, dir_path, exposure, cache, log_stream, is_use_predictions, stop_monitor=None):
     """Thread function for configuring and starting spin cameras"""
-    sc = SpinCamera(cam, acquire_stop, dir_path, cache=cache, log_stream=log_stream, is_use_predictions=is_use_predictions)
+    sc = SpinCamera(cam, acquire_stop, dir_path, cache=cache, log_stream=log_stream, is_use_predictions=is_use_predictions,
+                    stop_monitor=stop_monitor)
+    sc.begin_acquisition(exposure)
+    return sc
+
+
+def start_camera_session(sc: SpinCamera, acquire_stop, dir_path, exposure, cache, log_stream, is_use_predictions,
+                         stop_monitor=None):
+    """Thread function for starting a new session on a camera of the camera manager"""
+    sc.start_session(acquire_stop, dir_path, cache=cache, log_stream=log_stream,
+                     is_use_predictions=is_use_predictions, stop_monitor=stop_monitor)
     sc.begin_acquisition(exposure)
     return sc
 
@@ -365,6 +1016,93 @@ def start_streaming(sc: SpinCamera):
     del sc
 
 
+class QueueLogStream:
+    """Stream for camera loggers in the process engine, that forwards log lines to the parent process"""
+    def __init__(self, log_queue):
+        self.log_queue = log_queue
+
+    def write(self, s):
+        self.log_queue.put(('log', s))
+
+    def flush(self):
+        pass
+
+
+def camera_process(device_id, acquire_stop, dir_path, exposure, log_queue, is_use_predictions):
+    """Process function of the process engine. Open a single camera by its device ID and run its acquisition"""
+    system = PySpin.System.GetInstance()
+    cam_list = system.GetCameras()
+    filter_cameras(cam_list, device_id)
+    summary = {}
+    try:
+        if len(cam_list) == 0:
+            raise Exception(f'No camera matches device ID: {device_id}')
+        # redis connections can't be shared between processes, so each camera process opens its own
+        is_cache_needed = any(config.acquire_stop_options[k] == 'cache' for k in acquire_stop)
+        cache = RedisCache() if is_cache_needed else None
+        sc = start_camera(cam_list[0], acquire_stop, dir_path, exposure, cache, QueueLogStream(log_queue),
+                          is_use_predictions)
+        summary = sc.acquire()
+        del sc
+    except Exception as exc:
+        summary = {'error': str(exc)}
+    finally:
+        cam_list.Clear()
+        log_queue.put(('summary', device_id, summary))
+
+
+def start_camera_processes(device_ids, acquire_stop, dir_path, exposure, log_stream, is_use_predictions):
+    """
+    Run each camera in its own process, so frame conversion, encoding and prediction don't contend for the GIL.
+    Logs and acquisition summaries come back through a queue. A thread_event of the caller is mirrored
+    into a process event, while cache conditions are checked by the camera processes themselves.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    log_queue = ctx.Queue()
+    thread_event = acquire_stop.get('thread_event')
+    process_event = ctx.Event()
+    process_event.set()
+    acquire_stop = acquire_stop.copy()
+    if thread_event is not None:
+        acquire_stop['thread_event'] = process_event
+
+    processes = [ctx.Process(target=camera_process, name=f'camera-{device_id}',
+                             args=(device_id, acquire_stop, dir_path, exposure, log_queue, is_use_predictions))
+                 for device_id in device_ids]
+    for p in processes:
+        p.start()
+
+    def _handle_messages(timeout):
+        while True:
+            try:
+                msg = log_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if msg[0] == 'log':
+                log_stream.write(msg[1])
+            else:
+                _, device_id, summary = msg
+                log_stream.write(f'Camera {device_id} summary: {summary}\n')
+
+    while any(p.is_alive() for p in processes):
+        if thread_event is not None and not thread_event.is_set():
+            process_event.clear()
+        _handle_messages(timeout=0.1)
+
+    for p in processes:
+        p.join()
+    _handle_messages(timeout=0.1)
+
+
+def get_camera_list(cameras=None) -> PySpin.CameraList:
+    """Get the list of connected cameras, filtered by cameras string if given"""
+    system = PySpin.System.GetInstance()
+    cam_list = system.GetCameras()
+    if cameras:
+        filter_cameras(cam_list, cameras)
+    return cam_list
+
+
 def capture_image(camera: str, exposure=config.exposure_time) -> (np.ndarray, None):
     """
     Capture single image from a camera
@@ -372,6 +1110,13 @@ def capture_image(camera: str, exposure=config.exposure_time) -> (np.ndarray, No
     :param exposure: The exposure of the camera
     :return: Image numpy array
     """
+    if config.is_persistent_cameras:
+        with camera_manager.session(camera) as cameras:
+            if len(cameras) < 1:
+                print(f'No camera matches name: {camera}')
+                return
+            return cameras[0].capture_image(exposure)
+
     system = PySpin.System.GetInstance()
     cam_list = system.GetCameras()
     filter_cameras(cam_list, camera)
@@ -386,7 +1131,7 @@ def capture_image(camera: str, exposure=config.exposure_time) -> (np.ndarray, No
 
 
 def record(exposure=config.exposure_time, cameras=None, output=None, folder_prefix=None,
-           cache=None, is_use_predictions=False, **acquire_stop) -> str:
+           cache=None, is_use_predictions=False, engine=None, **acquire_stop) -> str:
     """
     Record videos from Arena's cameras
     :param exposure: The exposure time to be set to the cameras
@@ -395,17 +1140,16 @@ def record(exposure=config.exposure_time, cameras=None, output=None, folder_pref
     :param folder_prefix: Prefix to be added to folder name. Not used if output is given.
     :param cache: memory cache to be used by the cameras
     :param is_use_predictions: relevant for realtime camera only - using strike prediction
+    :param engine: 'thread' to run all cameras in threads of this process, or 'process' to run each camera
+                   in its own process. Default is config.record_engine.
     """
     if config.is_debug_mode:
         return 'DEBUG MODE'
     assert all(k in config.acquire_stop_options for k in acquire_stop.keys())
-    system = PySpin.System.GetInstance()
-    cam_list = system.GetCameras()
+    engine = engine or config.record_engine
+    assert engine in ['thread', 'process'], f'unknown record engine: {engine}'
     log_stream = get_log_stream()
 
-    if cameras:
-        filter_cameras(cam_list, cameras)
-
     if not output:
         folder_name = datetime_string()
         if folder_prefix:
@@ -413,17 +1157,51 @@ def record(exposure=config.exposure_time, cameras=None, output=None, folder_pref
         output = f"{config.output_dir}/{folder_name}"
     output = mkdir(output)
 
-    filtered = [(cam, acquire_stop, output, exposure, cache, log_stream, is_use_predictions) for cam in cam_list]
-    print(f'\nCameras detected: {len(filtered)}')
-    print(f'Acquire Stop: {acquire_stop}')
-    if filtered:
-        with Pool(len(filtered)) as pool:
-            results = pool.starmap(start_camera, filtered)
-            pool.starmap(start_streaming, [(sc,) for sc in results])
-        del filtered, results  # must delete this list in order to destroy all pointers to cameras.
-
-    cam_list.Clear()
-    # system.ReleaseInstance()
+    if engine == 'process':
+        if config.is_persistent_cameras:
+            camera_manager.close()  # the camera processes open the cameras by themselves
+        cam_list = get_camera_list(cameras)
+        device_ids = [get_device_id(cam) for cam in cam_list]
+        cam_list.Clear()
+        print(f'\nCameras detected: {len(device_ids)}')
+        print(f'Acquire Stop: {acquire_stop}')
+        if device_ids:
+            start_camera_processes(device_ids, acquire_stop, output, exposure, log_stream, is_use_predictions)
+        return log_stream.getvalue()
+
+    if is_use_predictions and IS_PREDICTOR_READY:
+        predictor.warmup_detector()  # load the detector while the cameras initialise
+
+    stop_monitor = None
+    if any(config.acquire_stop_options[k] == 'cache' for k in acquire_stop):
+        stop_monitor = AcquireStopMonitor(cache)
+        stop_monitor.start()
+
+    if config.is_persistent_cameras:
+        with camera_manager.session(cameras) as scs:
+            print(f'\nCameras detected: {len(scs)}')
+            print(f'Acquire Stop: {acquire_stop}')
+            if scs:
+                with Pool(len(scs)) as pool:
+                    pool.starmap(start_camera_session, [(sc, acquire_stop, output, exposure, cache, log_stream,
+                                                         is_use_predictions, stop_monitor) for sc in scs])
+                    pool.starmap(start_streaming, [(sc,) for sc in scs])
+    else:
+        cam_list = get_camera_list(cameras)
+        print(f'\nCameras detected: {len(cam_list)}')
+        print(f'Acquire Stop: {acquire_stop}')
+        filtered = [(cam, acquire_stop, output, exposure, cache, log_stream, is_use_predictions, stop_monitor)
+                    for cam in cam_list]
+        if filtered:
+            with Pool(len(filtered)) as pool:
+                results = pool.starmap(start_camera, filtered)
+                pool.starmap(start_streaming, [(sc,) for sc in results])
+            del filtered, results  # must delete this list in order to destroy all pointers to cameras.
+        cam_list.Clear()
+        # system.ReleaseInstance()
+
+    if stop_monitor is not None:
+        stop_monitor.stop()
 
     return log_stream.getvalue()
 
@@ -443,6 +1221,8 @@ def main():
                     help=f"Specify cameras exposure time. Default={config.exposure_time}")
     ap.add_argument("-c", "--camera", type=str, required=False,
                     help=f"filter cameras by last digits or according to CAMERA_NAMES (for more than one use ',').")
+    ap.add_argument("--engine", type=str, choices=['thread', 'process'], default=config.record_engine,
+                    help=f"Run cameras in threads or in separate processes. Default={config.record_engine}")
     ap.add_argument("-i", "--info", action="store_true", default=False,
                     help=f"Show cameras information")
 
@@ -455,7 +1235,7 @@ def main():
         for key in config.acquire_stop_options:
             if key in args:
                 acquire_stop[key] = args[key]
-        record(args.get('exposure'), args.get('camera'), args.get('output'), **acquire_stop)
+        record(args.get('exposure'), args.get('camera'), args.get('output'), engine=args.get('engine'), **acquire_stop)
 
 
 if __name__ == '__main__':
@@ -35,6 +35,7 @@ redis_host = env('REDIS_HOST', 'cache')
 mqtt_host = env('MQTT_HOST', 'mqtt')
 experiment_topic = "event/log/experiment"
 log_topic_prefix = "event/log/"
+metrics_topic = "event/metrics/acquisition"
 logger_files = {
     'touch': 'screen_touches.csv',
     'prediction': 'predictions.csv',
@@ -64,12 +65,26 @@ exposure_time = env.int('EXPOSURE_TIME', 8000)
 fps = env.int('FPS', 60)
 output_dir = env('OUTPUT_DIR', 'output')
 saved_frame_resolution = env.list('SAVED_FRAME_RESOLUTION', [1440, 1088])
+record_engine = env('RECORD_ENGINE', 'thread')  # thread or process
+is_persistent_cameras = env.bool('PERSISTENT_CAMERAS', False)  # keep cameras initialised between trials
+camera_channel_order = env('CAMERA_CHANNEL_ORDER', 'RGB')
+video_sink = env('VIDEO_SINK', 'opencv')  # opencv (MJPG avi) or ffmpeg (compressed mp4)
+video_codec = env('VIDEO_CODEC', 'libx265')
+video_preset = env('VIDEO_PRESET', 'fast')
+video_crf = env.int('VIDEO_CRF', 28)
+is_async_video_writer = env.bool('ASYNC_VIDEO_WRITER', False)
+frame_buffer_size = env.int('FRAME_BUFFER_SIZE', 32)
+frame_buffer_log_interval = env.int('FRAME_BUFFER_LOG_INTERVAL', 600)
+is_publish_metrics = env.bool('PUBLISH_ACQUISITION_METRICS', True)
+metrics_publish_interval = env.float('METRICS_PUBLISH_INTERVAL', 5)  # seconds between stage histograms publishes
 camera_names = {
     'realtime': '19506468',
     'right': '19506475',
     'left': '19506455',
     'back': '19506481',
 }
+timestamps_chunk_size = env.int('TIMESTAMPS_CHUNK_SIZE', 600)  # frames per timestamps write
+acquire_stop_poll_interval = env.float('ACQUIRE_STOP_POLL_INTERVAL', 0.2)  # seconds between cache checks
 acquire_stop_options = {
     'num_frames': int,
     'record_time': int,
@@ -95,7 +110,15 @@ info_fields = [
 
 # Real-time Predictor
 detector_thresh = env.float('DETECTOR_THRESH', 0.9)
+detector_backend = env('DETECTOR_BACKEND', 'darknet')  # darknet (GPU) or opencv (CPU)
+detector_threads = env.int('DETECTOR_THREADS', 0)  # threads of the opencv backend, 0 for the opencv default
 realtime_camera = env('REALTIME_CAMERA', 'realtime')
 is_disable_predictor = env.bool('DISABLE_PREDICTOR', False)
 is_predictor_experiment = env.bool('PREDICTOR_EXPERIMENT', False)
+is_async_predictor = env.bool('ASYNC_PREDICTOR', True)  # predict the newest frame on a worker thread
+is_predictor_roi = env.bool('PREDICTOR_ROI', False)  # detect around the last detection instead of the full frame
+predictor_roi_size = env.int('PREDICTOR_ROI_SIZE', 416)  # minimal ROI height in pixels
+predictor_roi_max_misses = env.int('PREDICTOR_ROI_MAX_MISSES', 5)  # misses before going back to full frame
+is_undistort_lookup = env.bool('UNDISTORT_LOOKUP', False)  # undistort detections with a precomputed pixel map
 predictor_model = env('PREDICTOR_MODEL', 'lstm')
+predictor_torch_threads = env.int('PREDICTOR_TORCH_THREADS', 0)  # torch CPU threads of the predictor, 0 for default
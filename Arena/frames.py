@@ -0,0 +1,42 @@
+"""
+Camera frames shared by the recorder, the realtime predictor and the web stream.
+
+The cameras deliver RGB arrays, while OpenCV video writers and encoders expect BGR and the YOLO detector expects RGB.
+Instead of letting each consumer convert the image on its own, a Frame carries the channel order of its data and
+caches the converted array, so a frame is converted at most once no matter how many consumers use it.
+"""
+
+import cv2
+import numpy as np
+
+CHANNEL_ORDERS = ('RGB', 'BGR')
+
+
+class Frame:
+    """Image array with its channel order and a cache of color conversions"""
+    def __init__(self, data: np.ndarray, channel_order='RGB', frame_id=None):
+        assert channel_order in CHANNEL_ORDERS, f'unknown channel order: {channel_order}'
+        self.data = data
+        self.channel_order = channel_order
+        self.frame_id = frame_id
+        self._converted = {channel_order: data}
+
+    def to(self, channel_order) -> np.ndarray:
+        """Return the image in the requested channel order. No copy is made if the order already matches"""
+        if channel_order not in self._converted:
+            assert channel_order in CHANNEL_ORDERS, f'unknown channel order: {channel_order}'
+            # swapping the R and B channels is the same operation in both directions
+            self._converted[channel_order] = cv2.cvtColor(self.data, cv2.COLOR_RGB2BGR)
+        return self._converted[channel_order]
+
+    def copy(self):
+        """Return a frame that owns a copy of the data, for consumers that outlive the camera buffer"""
+        return Frame(self.data.copy(), self.channel_order, self.frame_id)
+
+    def crop(self, x0, y0, x1, y1):
+        """Return a frame of the region [y0:y1, x0:x1]. The data is a view on this frame"""
+        return Frame(self.data[y0:y1, x0:x1], self.channel_order, self.frame_id)
+
+    @property
+    def shape(self):
+        return self.data.shape
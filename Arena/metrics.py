@@ -0,0 +1,104 @@
+"""
+Performance telemetry for the acquisition loop of the cameras.
+
+Every camera keeps a histogram of durations for each stage of its frame handling (grab wait, color conversion,
+predictor, video write and acquire-stop checks). The histograms are published periodically over MQTT on
+config.metrics_topic/<camera name>, so it's possible to see in production which stage takes the frame budget.
+"""
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+import config
+
+STAGES = ['grab_wait', 'color_conversion', 'predictor', 'video_write', 'stop_checks']
+# upper edges of the histogram bins in milliseconds; the last bin counts everything above the last edge
+BIN_EDGES_MS = [0.5, 1, 2, 4, 8, 12, 16.6, 25, 33, 50, 100, 250]
+
+
+class StageHistogram:
+    """Histogram of the durations of a single stage"""
+    def __init__(self, edges=BIN_EDGES_MS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration_ms):
+        self.counts[bisect.bisect_left(self.edges, duration_ms)] += 1
+        self.count += 1
+        self.total += duration_ms
+        self.max = max(self.max, duration_ms)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else None,
+            'max_ms': self.max,
+            'edges_ms': self.edges,
+            'counts': self.counts
+        }
+
+
+class AcquisitionMetrics:
+    """Stage histograms of a single camera, with a background thread that publishes them over MQTT"""
+    def __init__(self, camera_name, interval=config.metrics_publish_interval):
+        self.camera_name = camera_name
+        self.interval = interval
+        self.histograms = {stage: StageHistogram() for stage in STAGES}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.publisher = None
+
+    def add(self, stage, duration):
+        """Add the duration of a stage in seconds"""
+        with self.lock:
+            self.histograms[stage].add(duration * 1000)
+
+    @contextmanager
+    def measure(self, stage):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - t0)
+
+    def to_dict(self):
+        with self.lock:
+            return {stage: h.to_dict() for stage, h in self.histograms.items()}
+
+    def summary(self) -> str:
+        """One line per stage with its mean and max durations"""
+        lines = []
+        for stage, h in self.to_dict().items():
+            if h['count']:
+                lines.append(f'{stage}: mean {h["mean_ms"]:.2f} ms, max {h["max_ms"]:.2f} ms, count {h["count"]}')
+        return '\n'.join(lines)
+
+    def start(self):
+        """Start publishing the histograms every interval seconds"""
+        if not config.is_publish_metrics or self.publisher is not None:
+            return
+        self.publisher = threading.Thread(target=self._publish_loop, name=f'metrics-{self.camera_name}', daemon=True)
+        self.publisher.start()
+
+    def stop(self):
+        self.done.set()
+
+    def _publish_loop(self):
+        from mqtt import MQTTPublisher
+        mqtt_client = MQTTPublisher()
+        while not self.done.wait(self.interval):
+            self.publish(mqtt_client)
+        self.publish(mqtt_client)
+
+    def publish(self, mqtt_client):
+        try:
+            payload = json.dumps({'camera': self.camera_name, 'time': time.time(), 'stages': self.to_dict()})
+            mqtt_client.publish_event(f'{config.metrics_topic}/{self.camera_name}', payload)
+        except Exception as exc:
+            print(f'Error publishing metrics of {self.camera_name}: {exc}')
@@ -78,9 +78,14 @@ def get_logger(device_id: str, dir_path: str, log_stream=None) -> logging.Logger
 
 
 def calculate_fps(frame_times):
-    diffs = [j - i for i, j in zip(frame_times[:-1], frame_times[1:])]
-    fps = 1 / np.mean(diffs)
-    std = fps - (1 / (np.mean(diffs) + np.std(diffs) / np.sqrt(len(diffs))))
+    diffs = np.diff(np.asarray(frame_times, dtype=float))
+    return fps_from_diffs(diffs.mean(), diffs.std(), len(diffs))
+
+
+def fps_from_diffs(mean_diff, std_diff, num_diffs):
+    """Calculate FPS and its error from the mean and std of the time differences between frames"""
+    fps = 1 / mean_diff
+    std = fps - (1 / (mean_diff + std_diff / np.sqrt(num_diffs)))
     return fps, std
 
 
@@ -46,6 +46,7 @@ def main(origin, target):
 
             tmp_exp = f'{TMP_DIR}/{exp_dir.name}'
             subprocess.run(['cp', '-r', exp_dir.as_posix(), TMP_DIR])
+            # only MJPG recordings are re-encoded. Recordings of the ffmpeg video sink are already compressed mp4.
             for video_path in Path(tmp_exp).glob('**/*.avi'):
                 try:
                     vid_tmp = video_path.absolute().as_posix()